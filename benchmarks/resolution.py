@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+Benchmarks template resolution through the theme loaders, and the theme
+editor's folder browser, across numbers of themes, template depths, preview
+and non-preview users, storage backends, and with and without the compiled
+template cache.
+
+Everything runs in a throwaway project: an in-memory SQLite database, a
+local-memory cache and themes written to a temporary folder. Run it from the
+repository root with Django installed::
+
+    python benchmarks/resolution.py
+    python benchmarks/resolution.py --themes 1 10 50 --depth 4 --includes 8 --storage fs slow db --latency 5
+    python benchmarks/resolution.py --loader plain cached
+
+Each scenario reports the time and storage calls of the first, cold, render,
+then the mean, median and 95th percentile time per render, and the database
+queries and storage calls per render, once the caches have been warmed.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+# Set by ``main``, which creates the folder.
+THEMES_ROOT = None
+
+LOADERS = {
+    'plain': 'django_themes.loaders.ThemeTemplateLoader',
+    'cached': 'django_themes.loaders.CachedThemeTemplateLoader',
+}
+
+
+def templates_setting(loader):
+    return [{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'loaders': [
+                LOADERS[loader],
+                'django.template.loaders.app_directories.Loader',
+            ],
+            'context_processors': [
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    }]
+
+
+settings.configure(
+    DEBUG=False,
+    SECRET_KEY='benchmark',
+    ALLOWED_HOSTS=['*'],
+    ROOT_URLCONF=__name__,
+    INSTALLED_APPS=[
+        'django.contrib.admin',
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django.contrib.messages',
+        'django.contrib.staticfiles',
+        'django.contrib.humanize',
+        'django_themes',
+    ],
+    MIDDLEWARE=[
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+        'django_themes.middleware.PreviewWithCurrentUserMiddleware',
+    ],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    TEMPLATES=templates_setting('cached'),
+    STATIC_URL='/static/',
+    THEMES_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+    THEMES_TEMPLATE_CHECK_MODIFIED_TIME=False,
+    THEMES_METRICS=False,
+)
+django.setup()
+
+from django.conf.urls import url  # noqa: E402
+from django.contrib import admin  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.core.files.storage import FileSystemStorage  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.template.loader import get_template  # noqa: E402
+from django.test import Client, RequestFactory  # noqa: E402
+from django.test.utils import CaptureQueriesContext, override_settings  # noqa: E402
+
+from django_themes import loaders, registry  # noqa: E402
+from django_themes.dbstorage import DatabaseStorage  # noqa: E402
+from django_themes.middleware import enter_request, exit_request  # noqa: E402
+from django_themes.models import Theme  # noqa: E402
+from django_themes.storage import default_theme_storage, walk_storage  # noqa: E402
+from django_themes.utils import set_themes_to_preview  # noqa: E402
+
+urlpatterns = [url(r'^admin/', admin.site.urls)]
+
+
+class CountingStorage(FileSystemStorage):
+    """
+    A ``FileSystemStorage`` that counts calls, and can wait ``latency``
+    seconds on each one to stand in for network storage such as S3.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.latency = kwargs.pop('latency', 0)
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.calls = 0
+
+    def call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _open(self, name, mode='rb'):
+        self.call()
+        return super(CountingStorage, self)._open(name, mode)
+
+    def exists(self, name):
+        self.call()
+        return super(CountingStorage, self).exists(name)
+
+    def listdir(self, path):
+        self.call()
+        return super(CountingStorage, self).listdir(path)
+
+    def size(self, name):
+        self.call()
+        return super(CountingStorage, self).size(name)
+
+    def get_modified_time(self, name):
+        self.call()
+        return super(CountingStorage, self).get_modified_time(name)
+
+    def listdir_with_stats(self, path):
+        self.call()
+        from django_themes.storage import listdir_with_stats_local
+        return listdir_with_stats_local(self, path)
+
+
+class CountingDatabaseStorage(DatabaseStorage):
+    """
+    A ``DatabaseStorage`` that counts calls. Its queries are also counted as
+    database queries.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingDatabaseStorage, self).__init__(*args, **kwargs)
+        self.calls = 0
+
+    def _open(self, name, mode='rb'):
+        self.calls += 1
+        return super(CountingDatabaseStorage, self)._open(name, mode)
+
+    def exists(self, name):
+        self.calls += 1
+        return super(CountingDatabaseStorage, self).exists(name)
+
+    def listdir(self, path):
+        self.calls += 1
+        return super(CountingDatabaseStorage, self).listdir(path)
+
+    def listdir_with_stats(self, path):
+        self.calls += 1
+        return super(CountingDatabaseStorage, self).listdir_with_stats(path)
+
+
+def write_file(root, name, contents):
+    path = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fh:
+        fh.write(contents)
+
+
+def write_themes(root, theme_count, depth, includes):
+    """
+    Writes ``theme_count`` themes, plus one more only used for previews.
+    ``page.html`` extends a chain of ``depth`` layouts, each including
+    ``includes`` snippets. Every template lives in the lowest ranked theme,
+    so lookups have to pass over the others, and every other theme overrides
+    one snippet.
+    """
+    base = os.path.join(root, 'theme0', 'templates')
+    for level in range(depth):
+        parent = '{%% extends "layout%d.html" %%}' % (level + 1) if level + 1 < depth else ''
+        body = "".join('{%% include "snippet%d.html" %%}' % i for i in range(includes))
+        write_file(base, 'layout%d.html' % level, '%s{%% block level%d %%}%s{%% endblock %%}' % (parent, level, body))
+    write_file(base, 'page.html', '{% extends "layout0.html" %}{% block level0 %}page{% endblock %}')
+    for i in range(includes):
+        write_file(base, 'snippet%d.html' % i, 'snippet %d' % i)
+    for theme in range(1, theme_count + 1):
+        write_file(
+            os.path.join(root, 'theme%d' % theme, 'templates'),
+            'snippet%d.html' % (theme % max(includes, 1)), 'override %d' % theme
+        )
+
+
+def make_storage(kind, latency):
+    if kind == 'db':
+        storage = CountingDatabaseStorage()
+        source = FileSystemStorage(location=THEMES_ROOT)
+        for name in walk_storage(source, ''):
+            with source.open(name) as fh:
+                storage.replace(name, fh)
+        return storage
+    return CountingStorage(location=THEMES_ROOT, latency=latency if kind == 'slow' else 0)
+
+
+def reset(theme_count, depth, includes, storage_kind, latency):
+    shutil.rmtree(THEMES_ROOT, ignore_errors=True)
+    os.makedirs(THEMES_ROOT)
+    write_themes(THEMES_ROOT, theme_count, depth, includes)
+
+    Theme.objects.all().delete()
+    cache.clear()
+    loaders.invalidate_template_cache()
+    default_theme_storage._wrapped = make_storage(storage_kind, latency)
+
+    for theme in range(theme_count + 1):
+        Theme.objects.create(
+            name='Theme %d' % theme, path='theme%d' % theme, order=theme + 1,
+            is_active=theme < theme_count, author='bench', version='1',
+        )
+    registry.bump_generation()
+    return default_theme_storage._wrapped
+
+
+def percentile(times, share):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * share))]
+
+
+def measure(storage, renders, run):
+    storage.calls = 0
+    start = time.time()
+    run()
+    first, first_calls = (time.time() - start) * 1000, storage.calls
+    times, queries, calls = [], 0, 0
+    for i in range(renders):
+        storage.calls = 0
+        with CaptureQueriesContext(connection) as captured:
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+        queries += len(captured)
+        calls += storage.calls
+    return {
+        'first': first,
+        'first_storage': first_calls,
+        'mean': sum(times) / len(times) * 1000,
+        'p50': percentile(times, 0.5) * 1000,
+        'p95': percentile(times, 0.95) * 1000,
+        'queries': queries / float(renders),
+        'storage': calls / float(renders),
+    }
+
+
+def render_page(user):
+    request = RequestFactory().get('/')
+    request.user = user
+    tokens = enter_request(request)
+    try:
+        get_template('page.html').render({})
+    finally:
+        exit_request(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--themes', type=int, nargs='+', default=[1, 5, 20, 50])
+    parser.add_argument('--depth', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--includes', type=int, default=5, help="Snippets included by each layout.")
+    parser.add_argument('--storage', nargs='+', default=['fs', 'slow', 'db'], choices=['fs', 'slow', 'db'])
+    parser.add_argument(
+        '--loader', nargs='+', default=['plain', 'cached'], choices=sorted(LOADERS),
+        help="ThemeTemplateLoader, or CachedThemeTemplateLoader which also keeps compiled templates."
+    )
+    parser.add_argument('--latency', type=float, default=2, help="Milliseconds added to each call by 'slow' storage.")
+    parser.add_argument('--renders', type=int, default=50)
+    args = parser.parse_args()
+
+    global THEMES_ROOT
+    THEMES_ROOT = tempfile.mkdtemp(prefix='django-themes-bench-')
+    try:
+        call_command('migrate', verbosity=0)
+        admin_user = User.objects.create_superuser('bench', 'bench@example.com', 'bench')
+        client = Client()
+        client.force_login(admin_user)
+
+        row = "%-8s %-7s %6s %5s %-9s %9s %7s %9s %9s %9s %8s %8s"
+        print(row % (
+            'storage', 'loader', 'themes', 'depth', 'case', 'first ms', 'storage',
+            'mean ms', 'p50 ms', 'p95 ms', 'queries', 'storage'
+        ))
+        for storage_kind in args.storage:
+            for loader in args.loader:
+                with override_settings(TEMPLATES=templates_setting(loader), THEMES_FILE_ROOT=THEMES_ROOT):
+                    for theme_count in args.themes:
+                        for depth in args.depth:
+                            storage = reset(theme_count, depth, args.includes, storage_kind, args.latency / 1000.0)
+                            preview = Theme.objects.get(path='theme%d' % theme_count)
+                            set_themes_to_preview(admin_user, [preview])
+                            anonymous = User(pk=None)
+                            browser_url = '/admin/django_themes/theme/%d/files/templates/' % Theme.objects.get(path='theme0').pk
+                            cases = [
+                                ('render', lambda: render_page(anonymous)),
+                                ('preview', lambda: render_page(admin_user)),
+                                ('browser', lambda: client.get(browser_url)),
+                            ]
+                            for case, run in cases:
+                                result = measure(storage, args.renders, run)
+                                print(row % (
+                                    storage_kind, loader, theme_count, depth, case,
+                                    "%.3f" % result['first'], result['first_storage'],
+                                    "%.3f" % result['mean'], "%.3f" % result['p50'], "%.3f" % result['p95'],
+                                    "%.1f" % result['queries'], "%.1f" % result['storage'],
+                                ))
+    finally:
+        shutil.rmtree(THEMES_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
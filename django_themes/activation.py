@@ -0,0 +1,170 @@
+"""
+Switching the set of active themes in one step, after warming it up.
+
+Activating a set of themes first resolves and compiles every template they
+hold, so syntax errors stop the switch and the template manifests and this
+process's template caches are filled. The active flags are then changed and
+the new registry snapshot published in a single generation switch, which
+doesn't mark any template as changed. What changed is remembered, so it can
+be switched back.
+
+Themes limited to some hosts are only replaced by themes for the same hosts,
+so activating one tenant's themes leaves every other tenant's alone.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, engines
+
+from django_themes import registry
+from django_themes.manifest import get_template_manifests
+from django_themes.utils import THEME_CACHE_KEY_PREFIX, host_patterns
+
+ACTIVATION_CACHE_KEY = THEME_CACHE_KEY_PREFIX + "activation-v2"
+
+
+class ActivationError(Exception):
+    pass
+
+
+def get_theme_loader():
+    """
+    Returns the ``ThemeTemplateLoader`` used by the first template engine
+    that has one, or ``None``.
+    """
+    from django_themes.loaders import ThemeTemplateLoader
+
+    for backend in engines.all():
+        engine = getattr(backend, 'engine', None)
+        for loader in getattr(engine, 'template_loaders', []):
+            if isinstance(loader, ThemeTemplateLoader):
+                return loader
+    return None
+
+
+def warm_themes(themes):
+    """
+    Resolves and compiles every template in ``themes``, returning a list of
+    ``(template name, error)`` for those that fail to compile.
+    """
+    loader = get_theme_loader()
+    if loader is None:
+        return []
+
+    # Rebuilt from storage, so templates written without going through the
+    # admin are checked too.
+    names = set()
+    for manifest in get_template_manifests(themes, rebuild=True).values():
+        names.update(manifest)
+
+    errors = []
+    for name in sorted(names):
+        key = loader.get_cache_key(name, themes)
+        try:
+            loader.load_template(key, name, themes)
+        except TemplateDoesNotExist:
+            pass
+        except TemplateSyntaxError as e:
+            errors.append((name, str(e)))
+    return errors
+
+
+def activation_changes(themes):
+    """
+    Returns ``(activated, deactivated, hosts)`` for making ``themes`` the
+    active ones: the pks of the themes that will be switched on and off, and
+    the host patterns of every theme active afterwards, by pk.
+
+    An active theme is switched off if it shares a host pattern with one of
+    ``themes``, or if it has no hosts and one of ``themes`` has none either.
+    """
+    from django_themes.models import Theme
+
+    hosts = dict((pk, host_patterns(value)) for pk, value in Theme.objects.filter(is_active=True).values_list('pk', 'hosts'))
+    selected = dict((theme.pk, host_patterns(theme.hosts)) for theme in themes)
+    patterns = set()
+    for theme_patterns in selected.values():
+        patterns.update(theme_patterns)
+    shared = any(not theme_patterns for theme_patterns in selected.values())
+
+    deactivated = [
+        pk for pk, theme_patterns in hosts.items()
+        if pk not in selected and (patterns.intersection(theme_patterns) or (shared and not theme_patterns))
+    ]
+    activated = [pk for pk in selected if pk not in hosts]
+    for pk in deactivated:
+        del hosts[pk]
+    hosts.update(selected)
+    return activated, deactivated, hosts
+
+
+def activate_themes(themes):
+    """
+    Makes ``themes`` the active themes for the hosts they're used for, after
+    warming up every set of themes they will be part of. Raises
+    ``ActivationError`` listing the broken templates if any fail to compile,
+    in which case nothing is changed.
+    """
+    pks = set(theme.pk for theme in themes)
+    previous = registry.get_snapshot()
+    generation = registry.next_generation()
+    activated, deactivated, hosts = activation_changes(themes)
+
+    active = [
+        entry for entry in sorted(previous.themes.values(), key=lambda entry: (-entry.order, entry.pk))
+        if entry.pk in hosts
+    ]
+    default, host_sets = registry.build_theme_sets(active, hosts, previous.chains)
+    theme_sets = set(
+        theme_set.resolved for theme_set in [default] + list(host_sets.values())
+        if pks.intersection(entry.pk for entry in theme_set.active)
+    )
+    errors = set()
+    for resolved in theme_sets:
+        errors.update(warm_themes(resolved))
+    if errors:
+        raise ActivationError(sorted(errors))
+
+    from django_themes.models import Theme
+
+    def switch():
+        registry.publish_snapshot(registry.build_snapshot(generation))
+        cache.set(ACTIVATION_CACHE_KEY, {
+            'generation': generation,
+            'activated': activated,
+            'deactivated': deactivated,
+        }, None)
+
+    with transaction.atomic():
+        # ``update`` sends no signals, so the generation only changes once,
+        # when the new snapshot is published.
+        Theme.objects.filter(pk__in=pks).update(is_active=True)
+        Theme.objects.filter(pk__in=deactivated).update(is_active=False)
+        transaction.on_commit(switch)
+    return generation
+
+
+def get_last_activation():
+    return cache.get(ACTIVATION_CACHE_KEY)
+
+
+def rollback_activation():
+    """
+    Undoes the last activation, switching back on the themes it switched off
+    and off the ones it switched on, in a single generation switch. No
+    template files change, so every worker keeps the templates it cached for
+    those themes.
+    """
+    activation = get_last_activation()
+    if activation is None:
+        raise ActivationError("There is no theme activation to roll back.")
+
+    from django_themes.models import Theme
+
+    def switch():
+        registry.publish_snapshot(registry.build_snapshot(registry.next_generation()))
+        cache.delete(ACTIVATION_CACHE_KEY)
+
+    with transaction.atomic():
+        Theme.objects.filter(pk__in=activation['deactivated']).update(is_active=True)
+        Theme.objects.filter(pk__in=activation['activated']).update(is_active=False)
+        transaction.on_commit(switch)
@@ -1,3 +1,4 @@
+import mimetypes
 import posixpath
 
 from django import forms
@@ -5,9 +6,10 @@ from django.conf.urls import url
 from django.contrib import admin, messages
 from django.contrib.auth.decorators import permission_required
 from django.core.cache import cache
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, SuspiciousFileOperation
 from django.core.files.base import ContentFile
-from django.http import Http404
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.http import Http404, StreamingHttpResponse
 from django.http.response import JsonResponse 
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse
@@ -16,12 +18,18 @@ from django.utils.safestring import mark_safe
 from django.utils.text import capfirst
 from django.utils.decorators import method_decorator
 
-from dbtemplates.utils.template import check_template_syntax
-
-
+from django_themes.activation import ActivationError, activate_themes, get_last_activation, rollback_activation
+from django_themes.archive import ArchiveError, export_theme, import_theme
+from django_themes.dependencies import get_used_by
 from django_themes.models import Theme
-from django_themes.utils import add_theme_to_preview, get_previewing_themes, set_themes_to_preview, sizeof_fmt
-from django_themes.storage import default_theme_storage
+from django_themes.publish import PUBLISH_DIR
+from django_themes.signals import theme_file_changed
+from django_themes.utils import get_previewing_themes, remove_themes_from_preview, set_themes_to_preview, sizeof_fmt, theme_path_errors
+from django_themes.responses import file_response
+from django_themes.storage import default_theme_storage, listdir_with_stats, read_text, replace_file
+from django_themes.uploads import (
+    UPLOAD_CHUNK_SIZE, UPLOAD_DIR, UPLOAD_MAX_SIZE, UploadError, assemble_upload, received_chunks, save_chunk, save_files
+)
 
 
 class ThemeAdminForm(forms.ModelForm):
@@ -42,10 +50,17 @@ class ThemeAdminFileForm(forms.Form):
     def clean_path(self):
         path = self.cleaned_data.get("path")
 
-        if '..' in path:
-            self.add_error("path", "No relative paths allowed.")
-        if path.endswith('/') or path.endswith('\\'):
-            self.add_error("path", "A filename must follow be included after a directory separator.")
+        for error in theme_path_errors(path):
+            self.add_error("path", error)
+        return path
+
+
+class ThemeAdminImportForm(forms.Form):
+    archive = forms.FileField(help_text=_("A zip archive exported from a theme."))
+    replace = forms.BooleanField(
+        label=_("Remove other files"), required=False, initial=True,
+        help_text=_("Delete files in the theme that aren't in the archive."),
+    )
 
 
 class ThemeAdminUploadFileForm(forms.Form):
@@ -67,60 +82,76 @@ class ThemeAdmin(admin.ModelAdmin):
             'fields': ('author', 'name', 'description'),
         }),
         (_('Advanced'), {
-            'fields': (('is_active', 'order', 'path'),),
+            'fields': (('is_active', 'order', 'path'), 'parent', 'hosts'),
             'classes': ('monospace',),
         }),
     )
 
-    list_display = ('name', 'is_active','is_previewing', 'order', 'author', 'updated_at')
+    list_display = ('name', 'is_active','is_previewing', 'order', 'parent', 'author', 'updated_at')
 
     save_as = True
     search_fields = ('name', 'description')
     # actions = ['invalidate_cache', 'repopulate_cache', 'check_syntax']
-    actions = ['preview_themes']
+    actions = ['preview_themes', 'stop_previewing_themes', 'activate_selected_themes']
 
     def get_changelist(self, request, **kwargs):
         self.request = request
         return super(ThemeAdmin, self).get_changelist(request, **kwargs)
 
     def is_previewing(self, obj):
-        return obj.pk in get_previewing_themes(self.request.user)
+        # Looked up once per changelist, rather than once per row.
+        previewing = getattr(self.request, 'themes_previewing', None)
+        if previewing is None:
+            previewing = self.request.themes_previewing = set(get_previewing_themes(self.request.user))
+        return obj.pk in previewing
     is_previewing.short_description = 'Previewing?'
     is_previewing.boolean = True
 
-    # def preview_themes(self, request, queryset):
-    #     errors = []
-    #     for template in queryset:
-    #         valid, error = check_template_syntax(template)
-    #         if not valid:
-    #             errors.append('%s: %s' % (template.name, error))
-    #     if errors:
-    #         count = len(errors)
-    #         message = ungettext(
-    #             "Template syntax check FAILED for %(names)s.",
-    #             "Template syntax check FAILED for %(count)d templates: %(names)s.",
-    #             count)
-    #         self.message_user(request, message %
-    #                           {'count': count, 'names': ', '.join(errors)})
-    #     else:
-    #         count = queryset.count()
-    #         message = ungettext(
-    #             "Template syntax OK.",
-    #             "Template syntax OK for %(count)d templates.", count)
-    #         self.message_user(request, message % {'count': count})
-    # preview_themes.short_description = _("Previewing themes")
-
     def preview_themes(self, request, queryset):
-        themes = []
-        count = queryset.count()
-        set_themes_to_preview(self.request.user, queryset)
-        message = _(
-            "Now previewing %(count)d templates: %(names)s."
-        )
+        themes = list(queryset)
+        set_themes_to_preview(request.user, themes)
+        message = ungettext(
+            "Now previewing %(count)d theme: %(names)s.",
+            "Now previewing %(count)d themes: %(names)s.",
+            len(themes))
         self.message_user(request, message %
-                          {'count': count, 'names': ', '.join(themes)})
+                          {'count': len(themes), 'names': ', '.join(str(theme) for theme in themes)})
     preview_themes.short_description = _("Preview themes")
 
+    def stop_previewing_themes(self, request, queryset):
+        themes = list(queryset)
+        remove_themes_from_preview(request.user, themes)
+        message = ungettext(
+            "Stopped previewing %(count)d theme.",
+            "Stopped previewing %(count)d themes.",
+            len(themes))
+        self.message_user(request, message % {'count': len(themes)})
+    stop_previewing_themes.short_description = _("Stop previewing themes")
+
+    def activate_selected_themes(self, request, queryset):
+        """
+        Makes the selected themes the active ones for their hosts, once all
+        of their templates have compiled.
+        """
+        themes = list(queryset)
+        try:
+            activate_themes(themes)
+        except ActivationError as e:
+            errors = ['%s: %s' % error for error in e.args[0]]
+            count = len(errors)
+            message = ungettext(
+                "Template syntax check FAILED for %(names)s.",
+                "Template syntax check FAILED for %(count)d templates: %(names)s.",
+                count)
+            self.message_user(request, message % {'count': count, 'names': ', '.join(errors)}, messages.ERROR)
+            return
+        message = ungettext(
+            "Activated %(count)d theme: %(names)s.",
+            "Activated %(count)d themes: %(names)s.",
+            len(themes))
+        self.message_user(request, message % {'count': len(themes), 'names': ', '.join(str(theme) for theme in themes)})
+    activate_selected_themes.short_description = _("Activate selected themes")
+
     def get_urls(self):
         """Returns the additional urls used by the theme editor admin pages."""
         urls = super(ThemeAdmin, self).get_urls()
@@ -132,10 +163,93 @@ class ThemeAdmin(admin.ModelAdmin):
         
         theme_edit_urls = [
             url("^(?P<theme_id>[^/]+)/files/(?P<path>.*?)$", admin_site.admin_view(self.theme_edit_view), name='%s_%s_theme_editor' % info),
+            url("^(?P<theme_id>[^/]+)/raw/(?P<path>.*?)$", admin_site.admin_view(self.raw_file_view), name='%s_%s_theme_raw' % info),
+            url("^(?P<theme_id>[^/]+)/export/$", admin_site.admin_view(self.export_view), name='%s_%s_theme_export' % info),
+            url("^import/$", admin_site.admin_view(self.import_view), name='%s_%s_theme_import' % info),
+            url("^rollback/$", admin_site.admin_view(self.rollback_view), name='%s_%s_theme_rollback' % info),
         ]
         return theme_edit_urls + urls
 
+    def file_changed(self, theme, path):
+        """Lets caches know a file in ``theme`` was written or deleted."""
+        theme_file_changed.send(sender=self.__class__, theme=theme, path=path)
+
+    @method_decorator(permission_required('django_themes.change_theme'))
+    def export_view(self, request, theme_id):
+        """Streams a zip archive of every file in a theme."""
+        theme = get_object_or_404(self.model, pk=theme_id)
+        response = StreamingHttpResponse(export_theme(theme), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="%s.zip"' % posixpath.basename(theme.path.strip('/'))
+        return response
+
+    @method_decorator(permission_required('django_themes.add_theme'))
+    @method_decorator(permission_required('django_themes.change_theme'))
+    def import_view(self, request):
+        """
+        Creates or updates a theme, and its files, from an uploaded zip archive.
+        """
+        opts = self.model._meta
+        form = ThemeAdminImportForm()
+        if request.method == 'POST':
+            form = ThemeAdminImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                try:
+                    theme, paths = import_theme(form.cleaned_data['archive'], replace=form.cleaned_data['replace'])
+                except ArchiveError as e:
+                    form.add_error('archive', str(e))
+                else:
+                    messages.success(request, _("Imported %(count)d files into %(theme)s.") % {'count': len(paths), 'theme': theme})
+                    return redirect(reverse("admin:django_themes_theme_change", args=(theme.pk,)))
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=opts,
+            title=_("Import theme"),
+            app_label=opts.app_label,
+            form=form,
+        )
+        return render(request, "admin/django_themes/theme/import.html", context)
+
+    @method_decorator(permission_required('django_themes.change_theme'))
+    def rollback_view(self, request):
+        """
+        Undoes the last activation of themes.
+        """
+        opts = self.model._meta
+        changelist_url = reverse("admin:%s_%s_changelist" % (opts.app_label, opts.model_name))
+        activation = get_last_activation()
+        if request.method == 'POST':
+            try:
+                rollback_activation()
+            except ActivationError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, _("Rolled back the last theme activation."))
+            return redirect(changelist_url)
+
+        activated_themes = deactivated_themes = []
+        if activation is not None:
+            activated_themes = self.model.objects.filter(pk__in=activation['activated'])
+            deactivated_themes = self.model.objects.filter(pk__in=activation['deactivated'])
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=opts,
+            title=_("Roll back theme activation"),
+            app_label=opts.app_label,
+            activation=activation,
+            activated_themes=activated_themes,
+            deactivated_themes=deactivated_themes,
+        )
+        return render(request, "admin/django_themes/theme/rollback.html", context)
+
     themes_folder_template = "admin/django_themes/editor/browser.html"
+    themes_folder_page_size = 250
+    # Files bigger than this are shown truncated and can't be edited in the browser.
+    themes_editor_max_size = 1024 * 1024
+    themes_preview_size = 16 * 1024
+    themes_media_types = ('image', 'audio', 'video')
+    # Folders django-themes keeps its own files in, which aren't shown or editable.
+    themes_hidden_folders = (PUBLISH_DIR, UPLOAD_DIR)
     themes_file_template = "admin/django_themes/editor/browser.html"
 
     @method_decorator(permission_required('django_themes.change_theme')) # user.has_perm('foo.change_bar')
@@ -154,6 +268,8 @@ class ThemeAdmin(admin.ModelAdmin):
                 for i, part in enumerate(parts)
             ]
         paths_and_parts.insert(0, (theme.name, ""))
+        if parts[0] in self.themes_hidden_folders:
+            raise Http404
 
         if request.GET.get('action', None):
             action = request.GET.get('action', None)
@@ -163,13 +279,15 @@ class ThemeAdmin(admin.ModelAdmin):
                 'new': self.new_file,
                 'upload': self.upload_file,
                 'upload_ajax': self.upload_file_ajax,
+                'download': self.download_file,
             }.get(action, None)
             print(method)
             if method:
                 return method(request, theme, path, paths_and_parts)
 
+        listing = None
         try:
-            default_theme_storage.listdir("/".join([theme.path, path]))
+            listing = listdir_with_stats(default_theme_storage, "/".join([theme.path, path]))
             _type = "folder"
         except:
             if not default_theme_storage.exists("/".join([theme.path, path])):
@@ -177,7 +295,7 @@ class ThemeAdmin(admin.ModelAdmin):
             _type = "file"
             
         if  _type == "folder":
-            return self.render_folder(request, theme, path, paths_and_parts)
+            return self.render_folder(request, theme, path, paths_and_parts, listing)
         else:
             return self.render_file(request, theme, path, paths_and_parts)
 
@@ -188,16 +306,22 @@ class ThemeAdmin(admin.ModelAdmin):
 
         
         template = "admin/django_themes/editor/file_text_viewer.html"
-        # file
-        lines = 0
-        contents = ""
-        size = None
-        with default_theme_storage.open("/".join([theme.path, path])) as fh:
-            size = " ".join(map(str,sizeof_fmt(fh.size)))
-            for line in fh:
-                contents+=line
-                lines += 1
-        # contents = .read()
+        full_path = "/".join([theme.path, path])
+        content_type = mimetypes.guess_type(path)[0] or ''
+        if content_type.split('/')[0] in self.themes_media_types:
+            return self.render_media_file(request, theme, path, paths_and_parts)
+
+        text = read_text(default_theme_storage, full_path, limit=self.themes_editor_max_size)
+        if text.binary:
+            return self.render_media_file(request, theme, path, paths_and_parts)
+
+        used_by = None
+        if path.startswith('templates/'):
+            used_by = [
+                {'theme': used_theme, 'name': name, 'path': posixpath.join('templates', name)}
+                for used_theme, name in get_used_by(list(self.model.objects.all()), path[len('templates/'):])
+            ]
+
         context = {
             "opts": opts,
             "title": "Viewing file {file} | Theme Editor {theme.name}".format(theme=theme, file=path),
@@ -207,19 +331,67 @@ class ThemeAdmin(admin.ModelAdmin):
             "theme": theme,
             "path": path,
             "paths": paths_and_parts,
+            "used_by": used_by,
 
             "file": {
-                    'name': file,
+                    'name': path.split('/')[-1],
                     'path': path,
-                    'contents': contents,
-                    'lines': lines,
-                    'size': size,
+                    'contents': text.contents,
+                    'lines': text.lines,
+                    'size': " ".join(map(str,sizeof_fmt(text.size))),
+                    'truncated': text.truncated,
                     'ext': path.split('.')[-1]
                     # 'file': default_theme_storage
                 }
         }
         return render(request, template, context)
 
+    def render_media_file(self, request, theme, path, paths_and_parts):
+        opts = self.model._meta
+        template = "admin/django_themes/editor/file_media_viewer.html"
+        full_path = "/".join([theme.path, path])
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        context = {
+            "opts": opts,
+            "title": "Viewing file {file} | Theme Editor {theme.name}".format(theme=theme, file=path),
+
+            "app_label": opts.app_label,
+            "model_name": capfirst(opts.verbose_name),
+            "theme": theme,
+            "path": path,
+            "paths": paths_and_parts,
+
+            "file": {
+                    'name': path.split('/')[-1],
+                    'path': path,
+                    'size': " ".join(map(str,sizeof_fmt(default_theme_storage.size(full_path)))),
+                    'content_type': content_type,
+                    'media_type': content_type.split('/')[0],
+                    'ext': path.split('.')[-1]
+                }
+        }
+        return render(request, template, context)
+
+    def download_file(self, request, theme, path, paths_and_parts):
+        return self.raw_file_view(request, theme.pk, path)
+
+    @method_decorator(permission_required('django_themes.change_theme'))
+    def raw_file_view(self, request, theme_id, path):
+        """
+        Serves the bytes of a file in a theme, with support for conditional
+        and range requests.
+        """
+        theme = get_object_or_404(self.model, pk=theme_id)
+        path = path.strip('/')
+        full_path = "/".join([theme.path, path])
+        if '..' in path.split('/') or not default_theme_storage.exists(full_path):
+            raise Http404
+        return file_response(
+            request, default_theme_storage, full_path,
+            as_attachment=bool(request.GET.get('attachment'))
+        )
+
     def edit_file(self, request, theme, path, paths_and_parts):
         opts = self.model._meta
 
@@ -240,15 +412,13 @@ class ThemeAdmin(admin.ModelAdmin):
                     message = _("File '%s' saved successfully!") % path
                 
                 full_path = "/".join([theme.path, path])
-                if default_theme_storage.exists(full_path):
-                    with default_theme_storage.open(full_path, 'w') as fh:
-                        fh.write(request.POST.get('file_editor'))
-                else:
-                    default_theme_storage.save(full_path, ContentFile(request.POST.get('file_editor')))
+                replace_file(default_theme_storage, full_path, ContentFile(request.POST.get('file_editor')))
+                self.file_changed(theme, path)
     
                 messages.success(request, message)
                 if post_save_delete_path:
                     default_theme_storage.delete("/".join([theme.path, post_save_delete_path]))
+                    self.file_changed(theme, post_save_delete_path)
     
                 return redirect(
                     reverse("admin:django_themes_theme_theme_editor", kwargs={'theme_id':theme.pk, 'path':path})
@@ -256,17 +426,18 @@ class ThemeAdmin(admin.ModelAdmin):
 
         template = "admin/django_themes/editor/file_text_editor.html"
 
-        lines = 0
-        contents = ""
-        size = None
-        with default_theme_storage.open("/".join([theme.path, path])) as fh:
-            size = " ".join(map(str,sizeof_fmt(fh.size)))
-            for line in fh:
-                contents+=line
-                lines += 1
+        text = read_text(default_theme_storage, "/".join([theme.path, path]), limit=self.themes_editor_max_size)
+        if text.binary or text.truncated:
+            if text.binary:
+                messages.warning(request, _("File '%s' isn't text, so it can't be edited here, download it instead.") % path)
+            else:
+                messages.warning(request, _("File '%s' is too large to edit here, download it instead.") % path)
+            return redirect(
+                reverse("admin:django_themes_theme_theme_editor", kwargs={'theme_id':theme.pk, 'path':path})
+            )
 
         if form is None:
-            form = ThemeAdminFileForm(initial={'path':path, 'file_editor': contents})
+            form = ThemeAdminFileForm(initial={'path':path, 'file_editor': text.contents})
 
         context = {
             "opts": opts,
@@ -281,9 +452,9 @@ class ThemeAdmin(admin.ModelAdmin):
             "file": {
                     'name': path.split('/')[-1],
                     'path': path,
-                    'contents': contents,
-                    'lines': lines,
-                    'size': size,
+                    'contents': text.contents,
+                    'lines': text.lines,
+                    'size': " ".join(map(str,sizeof_fmt(text.size))),
                     'ext': path.split('.')[-1]
                     # 'file': default_theme_storage
                 }
@@ -295,6 +466,7 @@ class ThemeAdmin(admin.ModelAdmin):
 
         if request.POST:
             default_theme_storage.delete("/".join([theme.path, path]))
+            self.file_changed(theme, path)
             message = _("File '%s' deleted successfully!") % path
             messages.success(request, message)
             return redirect(
@@ -303,14 +475,7 @@ class ThemeAdmin(admin.ModelAdmin):
 
         template = "admin/django_themes/editor/file_delete.html"
 
-        lines = 0
-        contents = ""
-        size = None
-        with default_theme_storage.open("/".join([theme.path, path])) as fh:
-            size = " ".join(map(str,sizeof_fmt(fh.size)))
-            for line in fh:
-                contents+=line
-                lines += 1
+        text = read_text(default_theme_storage, "/".join([theme.path, path]), limit=self.themes_preview_size)
 
         context = {
             "opts": opts,
@@ -325,35 +490,52 @@ class ThemeAdmin(admin.ModelAdmin):
             "file": {
                     'name': path.split('/')[-1],
                     'path': path,
-                    'contents': contents,
-                    'lines': lines,
-                    'size': size,
+                    'contents': '' if text.binary else text.contents,
+                    'lines': text.lines,
+                    'size': " ".join(map(str,sizeof_fmt(text.size))),
+                    'truncated': text.truncated,
                     # 'file': default_theme_storage
                 }
         }
         return render(request, template, context)
 
-    def render_folder(self, request, theme, path, paths_and_parts):
+    def render_folder(self, request, theme, path, paths_and_parts, listing=None):
         opts = self.model._meta
-        _folders, _files = default_theme_storage.listdir("/".join([theme.path, path]))
-        folders = [{'name': folder, 'path': posixpath.join(path, folder)} for folder in _folders]
+        if listing is None:
+            listing = listdir_with_stats(default_theme_storage, "/".join([theme.path, path]))
+        _folders, _files = listing
+        if not path:
+            _folders = [folder for folder in _folders if folder not in self.themes_hidden_folders]
+
+        entries = [
+            {'name': folder, 'path': posixpath.join(path, folder), 'is_folder': True}
+            for folder in sorted(_folders)
+        ] + [
+            {
+                'name': stat.name,
+                'path': posixpath.join(path, stat.name),
+                'size': " ".join(sizeof_fmt(stat.size)),
+                'modified': stat.modified,
+                'is_folder': False,
+            }
+            for stat in sorted(_files, key=lambda stat: stat.name)
+        ]
+        paginator = Paginator(entries, self.themes_folder_page_size)
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
+
+        folders = [entry for entry in page.object_list if entry['is_folder']]
+        files = [entry for entry in page.object_list if not entry['is_folder']]
         
         if len(paths_and_parts) > 1:
             folders.insert(0,
                 {'name': '..', 'path': paths_and_parts[-2][-1]}
             )
-            
-        files = []
-
-        for file in _files:
-            fname = "/".join([theme.path, path, file])
-            fh = default_theme_storage.open(fname)
-            files.append({
-                    'name': file,
-                    'path': posixpath.join(path, file),
-                    'size': " ".join(sizeof_fmt(fh.size)),
-                    'modified': default_theme_storage.modified_time(fname)
-                })
+
         context = {
             "opts": opts,
             "title": "Viewing {folder} | Theme Editor {theme.name}".format(theme=theme, folder=path),
@@ -366,6 +548,7 @@ class ThemeAdmin(admin.ModelAdmin):
 
             "files": files,
             "folders": folders,
+            "page": page,
 
         }
         return render(request, self.themes_folder_template, context)
@@ -384,8 +567,8 @@ class ThemeAdmin(admin.ModelAdmin):
                 message = _("File '%s' saved successfully!") % path
                 
                 full_path = "/".join([theme.path, path])
-                with default_theme_storage.open(full_path, 'w') as fh:
-                    fh.write(request.POST.get('file_editor'))
+                replace_file(default_theme_storage, full_path, ContentFile(request.POST.get('file_editor')))
+                self.file_changed(theme, path)
 
                 messages.success(request, message)
 
@@ -427,10 +610,7 @@ class ThemeAdmin(admin.ModelAdmin):
                 message = _("Files uploaded successfully!") 
                 
 
-                files = request.FILES.getlist('file_upload')
-                for f in files:
-                    full_path = "/".join([theme.path, path, f.name])
-                    default_theme_storage.save(full_path, f)
+                self.save_uploads(theme, path, request.FILES.getlist('file_upload'))
 
                 messages.success(request, message)
 
@@ -453,19 +633,65 @@ class ThemeAdmin(admin.ModelAdmin):
             "path": path,
             "paths": paths_and_parts,
             "form": form,
+            "upload_max_size_mb": UPLOAD_MAX_SIZE / (1024.0 * 1024),
+            "upload_chunk_size": UPLOAD_CHUNK_SIZE,
         }
         return render(request, template, context)
 
+    def save_uploads(self, theme, path, files):
+        """Saves uploaded files into ``path`` in ``theme``, several at a time."""
+        saved = save_files(
+            ("/".join([theme.path, path, f.name]), f)
+            for f in files
+        )
+        theme_root = posixpath.normpath(theme.path)
+        for name in saved:
+            self.file_changed(theme, posixpath.normpath(name)[len(theme_root):].lstrip('/'))
+
+    def upload_chunk_ajax(self, request, theme, path, upload_id):
+        """
+        Receives one chunk of a chunked upload, or with ``done`` set joins the
+        chunks received so far into the uploaded file.
+        """
+        try:
+            if request.POST.get('done'):
+                filename = posixpath.basename(request.POST.get('filename', '').replace('\\', '/'))
+                if not filename or filename in ('.', '..'):
+                    raise UploadError("A filename is required.")
+                saved = assemble_upload(
+                    upload_id,
+                    "/".join([theme.path, path, filename]),
+                    request.POST.get('dztotalchunkcount') or 0,
+                    request.POST.get('dztotalfilesize'),
+                )
+                theme_root = posixpath.normpath(theme.path)
+                self.file_changed(theme, posixpath.normpath(saved)[len(theme_root):].lstrip('/'))
+                return JsonResponse({"ok": _("Files uploaded successfully!")})
+
+            chunk = request.FILES.get('file_upload')
+            if chunk is None:
+                raise UploadError("No chunk was sent.")
+            save_chunk(upload_id, request.POST.get('dzchunkindex', 0), chunk)
+            return JsonResponse({"ok": _("Chunk received.")})
+        except (UploadError, SuspiciousFileOperation, ValueError) as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
     def upload_file_ajax(self, request, theme, path, paths_and_parts):
         message = {}
         code = 200
-        if request.POST:
-            print("FILES ARE AJAXY", request.FILES.getlist('file_upload'))
+        upload_id = request.POST.get('dzuuid') or request.GET.get('dzuuid')
+        if upload_id and request.method == 'POST':
+            return self.upload_chunk_ajax(request, theme, path, upload_id)
+        elif upload_id:
+            # Lets a client resume an upload by only sending missing chunks.
+            try:
+                return JsonResponse({"chunks": received_chunks(upload_id)})
+            except SuspiciousFileOperation as e:
+                return JsonResponse({"error": str(e)}, status=400)
+
+        if request.method == 'POST':
             try:
-                files = request.FILES.getlist('file_upload')
-                for f in files:
-                    full_path = "/".join([theme.path, path, f.name])
-                    default_theme_storage.save(full_path, f)
+                self.save_uploads(theme, path, request.FILES.getlist('file_upload'))
                 message = {"ok": _("Files uploaded successfully!")}
                 code = 200
             except:
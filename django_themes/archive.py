@@ -0,0 +1,215 @@
+"""
+Exporting themes to, and importing them from, zip archives.
+
+An archive holds every file in the theme at the same path it has within the
+theme, plus a ``theme.json`` file with the fields of the ``Theme`` itself. The
+parent theme is stored by its path, so it can be found in another database.
+"""
+import json
+import posixpath
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ValidationError
+from django.core.files.base import File
+from django.db import connection
+
+from django_themes.manifest import reset_manifests
+from django_themes.publish import PUBLISH_DIR, get_published_manifest, publish_theme
+from django_themes.registry import bump_generation
+from django_themes.storage import default_theme_storage, replace_file, walk_storage
+from django_themes.uploads import SPOOL_SIZE, UPLOAD_DIR, UPLOAD_WORKERS
+from django_themes.utils import theme_path_errors
+
+METADATA_NAME = 'theme.json'
+METADATA_FIELDS = ('name', 'author', 'version', 'description', 'order', 'path', 'hosts')
+SKIPPED_FOLDERS = (PUBLISH_DIR, UPLOAD_DIR)
+CHUNK_SIZE = 64 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class StreamBuffer(object):
+    """
+    A write-only file that hands back whatever was written to it since it was
+    last emptied, so ``zipfile`` can write to a streaming response.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def theme_metadata(theme):
+    metadata = dict((field, getattr(theme, field)) for field in METADATA_FIELDS)
+    metadata['parent'] = theme.parent.path if theme.parent_id else None
+    return metadata
+
+
+def export_theme(theme):
+    """
+    Yields a zip archive of ``theme`` a piece at a time, reading one file from
+    theme storage at a time and never holding the whole archive in memory.
+    """
+    buf = StreamBuffer()
+    with zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(METADATA_NAME, json.dumps(theme_metadata(theme), indent=1, sort_keys=True))
+        yield buf.pop()
+
+        for path in walk_storage(default_theme_storage, theme.path):
+            if path.split('/')[0] in SKIPPED_FOLDERS:
+                continue
+            info = zipfile.ZipInfo(path, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with default_theme_storage.open(posixpath.join(theme.path, path)) as src:
+                with archive.open(info, mode='w', force_zip64=True) as dest:
+                    for data in src.chunks(CHUNK_SIZE):
+                        dest.write(data)
+                        yield buf.pop()
+            yield buf.pop()
+    yield buf.pop()
+
+
+def read_metadata(archive):
+    try:
+        with archive.open(METADATA_NAME) as fh:
+            metadata = json.loads(fh.read().decode('utf-8'))
+    except KeyError:
+        raise ArchiveError("The archive has no %s file." % METADATA_NAME)
+    except ValueError:
+        raise ArchiveError("%s isn't valid JSON." % METADATA_NAME)
+    return dict((field, metadata[field]) for field in METADATA_FIELDS + ('parent',) if field in metadata)
+
+
+def find_parent(path):
+    from django_themes.models import Theme
+
+    if not path:
+        return None
+    parent = Theme.objects.filter(path=path).order_by('pk').first()
+    if parent is None:
+        raise ArchiveError("The parent theme, with path %s, needs to be imported first." % path)
+    return parent
+
+
+def remove_missing_files(theme, paths):
+    """
+    Deletes the files in ``theme`` that aren't in ``paths``, returning the
+    paths of the files deleted.
+    """
+    keep = set(paths)
+    removed = []
+    for path in list(walk_storage(default_theme_storage, theme.path)):
+        if path.split('/')[0] in SKIPPED_FOLDERS or path in keep:
+            continue
+        default_theme_storage.delete(posixpath.join(theme.path, path))
+        removed.append(path)
+    return removed
+
+
+def archive_members(archive):
+    """
+    Returns the files in ``archive`` to import, raising ``ArchiveError`` if
+    any of their paths aren't allowed in a theme.
+    """
+    members = []
+    for info in archive.infolist():
+        path = info.filename.replace('\\', '/')
+        if path.endswith('/') or path == METADATA_NAME:
+            continue
+        errors = theme_path_errors(path)
+        if path.startswith('/'):
+            errors.append("No absolute paths allowed.")
+        if errors:
+            raise ArchiveError("%s: %s" % (info.filename, " ".join(errors)))
+        if path.split('/')[0] in SKIPPED_FOLDERS:
+            continue
+        members.append((path, info))
+    return members
+
+
+def extract_member(archive, theme, path, info):
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            with archive.open(info) as src:
+                while True:
+                    data = src.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    spool.write(data)
+            spool.seek(0)
+            replace_file(
+                default_theme_storage,
+                posixpath.join(theme.path, path),
+                File(spool, name=posixpath.basename(path))
+            )
+        return path
+    finally:
+        connection.close()
+
+
+def import_theme(fileobj, theme=None, replace=True):
+    """
+    Imports the zip archive in ``fileobj``, returning the theme and the paths
+    of the files written. ``theme`` is updated from the archive's metadata if
+    given, otherwise the theme with the same path is, or a new one is created.
+    Files are unpacked one at a time per thread by a bounded pool of threads.
+    With ``replace``, files in the theme that aren't in the archive are
+    deleted, so the theme ends up exactly as it was exported.
+    """
+    from django_themes.models import Theme
+
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipfile:
+        raise ArchiveError("This isn't a zip archive.")
+
+    with archive:
+        metadata = read_metadata(archive)
+        members = archive_members(archive)
+
+        if theme is None:
+            path = metadata.get('path')
+            if not path or path.startswith('/') or theme_path_errors(path):
+                raise ArchiveError("%s needs a valid path." % METADATA_NAME)
+            theme = Theme.objects.filter(path=path).first() or Theme(is_active=False)
+        else:
+            metadata.pop('path', None)
+        if 'parent' in metadata:
+            metadata['parent'] = find_parent(metadata['parent'])
+        for field, value in metadata.items():
+            setattr(theme, field, value)
+        try:
+            theme.clean()
+        except ValidationError as e:
+            raise ArchiveError(" ".join(e.messages))
+        theme.save()
+
+        with ThreadPoolExecutor(max_workers=max(1, UPLOAD_WORKERS)) as executor:
+            paths = list(executor.map(
+                lambda member: extract_member(archive, theme, *member),
+                members
+            ))
+        if replace:
+            remove_missing_files(theme, paths)
+
+    if get_published_manifest(theme) is not None:
+        publish_theme(theme)
+    reset_manifests(theme)
+    bump_generation()
+    return theme, paths
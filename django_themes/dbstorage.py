@@ -0,0 +1,221 @@
+"""
+Theme storage kept in the database, for sites where theme files on shared
+network storage or S3 are too slow to read.
+
+Each file is a ``ThemeFile`` row pointing at a ``ThemeBlob`` holding its
+contents, keyed by their hash, so a file shared by several themes (or several
+versions of a theme) is only stored once. Existence checks, sizes, modified
+times and folder listings are indexed queries that never touch the blobs.
+
+Use it with::
+
+    THEMES_FILE_STORAGE = 'django_themes.dbstorage.DatabaseStorage'
+"""
+import errno
+import hashlib
+import posixpath
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.urls import NoReverseMatch, reverse
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+
+from django_themes.storage import FileStat
+
+
+def normalize_name(name):
+    name = posixpath.normpath((name or '').replace('\\', '/').strip('/'))
+    if name == '.':
+        return ''
+    if name == '..' or name.startswith('../'):
+        raise ValueError("Can't reach outside of theme storage: %s" % name)
+    return name
+
+
+def folder_prefix(folder):
+    return folder + '/' if folder else ''
+
+
+@deconstructible
+class DatabaseStorage(Storage):
+    """
+    Keeps files in the ``ThemeFile`` and ``ThemeBlob`` tables. ``location``
+    is accepted, and ignored, so it can be used as ``THEMES_FILE_STORAGE``.
+    """
+
+    def __init__(self, location=None, **kwargs):
+        self.location = location
+
+    def get_file(self, name):
+        from django_themes.models import ThemeFile
+
+        try:
+            return ThemeFile.objects.get(name=normalize_name(name))
+        except ThemeFile.DoesNotExist:
+            raise IOError(errno.ENOENT, "No such file in theme storage", name)
+
+    def _open(self, name, mode='rb'):
+        from django_themes.models import ThemeFile
+
+        if any(flag in mode for flag in 'wa+'):
+            raise ValueError("DatabaseStorage can't open files for writing, use save or replace instead.")
+        try:
+            theme_file = ThemeFile.objects.select_related('blob').get(name=normalize_name(name))
+        except ThemeFile.DoesNotExist:
+            raise IOError(errno.ENOENT, "No such file in theme storage", name)
+        return ContentFile(bytes(theme_file.blob.data), name=name)
+
+    def _save(self, name, content):
+        from django_themes.models import ThemeBlob, ThemeFile
+
+        name = normalize_name(name)
+        sha = hashlib.sha256()
+        chunks = []
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        for chunk in content.chunks():
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            sha.update(chunk)
+            chunks.append(chunk)
+        data = b''.join(chunks)
+
+        with transaction.atomic():
+            blob = self.lock_blob(sha.hexdigest())
+            if blob is None:
+                try:
+                    with transaction.atomic():
+                        blob = ThemeBlob.objects.create(hash=sha.hexdigest(), size=len(data), data=data)
+                except IntegrityError:
+                    # Saved at the same time by someone else.
+                    blob = self.lock_blob(sha.hexdigest())
+            previous = ThemeFile.objects.filter(name=name).values_list('blob_id', flat=True).first()
+            ThemeFile.objects.update_or_create(
+                name=name,
+                defaults={
+                    'folder': posixpath.dirname(name),
+                    'blob': blob,
+                    'size': blob.size,
+                    'modified_at': timezone.now(),
+                },
+            )
+            if previous is not None and previous != blob.hash:
+                self.delete_unused_blob(previous)
+        return name
+
+    def replace(self, name, content):
+        """
+        Saves ``content`` at exactly ``name``, overwriting any file there in
+        the same transaction. Used by ``storage.replace_file``.
+        """
+        return self._save(name, content)
+
+    def lock_blob(self, blob_hash):
+        """
+        Returns the ``ThemeBlob`` for ``blob_hash``, or ``None``, locking it
+        until the end of the transaction so it can't be deleted as unused
+        while a file is being pointed at it.
+        """
+        from django_themes.models import ThemeBlob
+
+        return ThemeBlob.objects.select_for_update().filter(hash=blob_hash).first()
+
+    def delete_unused_blob(self, blob_hash):
+        """
+        Deletes the blob for ``blob_hash`` if no file uses it. Must be called
+        in a transaction.
+        """
+        from django_themes.models import ThemeFile
+
+        blob = self.lock_blob(blob_hash)
+        if blob is not None and not ThemeFile.objects.filter(blob_id=blob_hash).exists():
+            blob.delete()
+
+    def get_available_name(self, name, max_length=None):
+        return super(DatabaseStorage, self).get_available_name(normalize_name(name), max_length=max_length)
+
+    def delete(self, name):
+        from django_themes.models import ThemeFile
+
+        with transaction.atomic():
+            theme_file = ThemeFile.objects.filter(name=normalize_name(name)).first()
+            if theme_file is None:
+                return
+            theme_file.delete()
+            self.delete_unused_blob(theme_file.blob_id)
+
+    def exists(self, name):
+        """
+        Returns whether ``name`` is a file, or a folder holding any files.
+        """
+        from django_themes.models import ThemeFile
+
+        name = normalize_name(name)
+        if not name:
+            return True
+        return ThemeFile.objects.filter(
+            Q(name=name) | Q(folder=name) | Q(folder__startswith=name + '/')
+        ).exists()
+
+    def list_folders(self, path):
+        from django_themes.models import ThemeFile
+
+        prefix = folder_prefix(path)
+        below = ThemeFile.objects.filter(folder__startswith=prefix).exclude(folder=path)
+        return sorted(set(
+            folder[len(prefix):].split('/')[0]
+            for folder in below.values_list('folder', flat=True).distinct()
+        ))
+
+    def check_folder(self, path, folders, files):
+        # Folders only exist while they hold files, so an empty listing means
+        # there is no such folder, as with FileSystemStorage.
+        if path and not folders and not files:
+            raise IOError(errno.ENOENT, "No such folder in theme storage", path)
+        return folders, files
+
+    def listdir(self, path):
+        from django_themes.models import ThemeFile
+
+        path = normalize_name(path)
+        files = ThemeFile.objects.filter(folder=path).order_by('name').values_list('name', flat=True)
+        return self.check_folder(path, self.list_folders(path), [posixpath.basename(name) for name in files])
+
+    def listdir_with_stats(self, path):
+        """
+        Lists ``path`` like ``listdir``, with the size and modified time of
+        each file from the same query. Used by ``storage.listdir_with_stats``.
+        """
+        from django_themes.models import ThemeFile
+
+        path = normalize_name(path)
+        files = ThemeFile.objects.filter(folder=path).order_by('name').values_list('name', 'size', 'modified_at')
+        return self.check_folder(path, self.list_folders(path), [
+            FileStat(posixpath.basename(name), size, modified)
+            for name, size, modified in files
+        ])
+
+    def size(self, name):
+        return self.get_file(name).size
+
+    def get_modified_time(self, name):
+        return self.get_file(name).modified_at
+
+    modified_time = get_modified_time
+
+    def url(self, name):
+        """
+        Returns the URL of ``name`` served by ``staticfiles.serve_file``,
+        which only serves files in the ``static`` folder of a theme.
+        """
+        try:
+            return reverse('django_themes_file', kwargs={'name': normalize_name(name)})
+        except NoReverseMatch:
+            raise ImproperlyConfigured(
+                "Files in DatabaseStorage are served by django-themes, "
+                "include 'django_themes.static_urls' in your URLconf to give them URLs."
+            )
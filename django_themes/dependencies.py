@@ -0,0 +1,134 @@
+"""
+Per-theme indexes of the templates each template extends or includes.
+
+Each theme's index maps its template names to the names they depend on
+through ``{% extends %}`` and ``{% include %}`` with a literal name. Indexes
+are kept in the cache next to the template manifests and updated one file at
+a time as files change, so saving a template only invalidates it and the
+templates that (directly or not) depend on it.
+"""
+import posixpath
+import re
+
+from django.core.cache import cache
+
+from django_themes.manifest import MANIFEST_TIMEOUT, dependency_cache_key, get_manifests, get_template_manifests
+from django_themes.storage import default_theme_storage, read_text
+
+DEPENDENCY_RE = re.compile(r"""{%\s*(?:extends|include)\s+(["'])(?P<name>[^"']+)\1""")
+COMMENT_RE = re.compile(r"{#.*?#}|{%\s*comment\s*%}.*?{%\s*endcomment\s*%}", re.DOTALL)
+# Templates bigger than this are only scanned this far for dependencies.
+SCAN_LIMIT = 1024 * 1024
+
+
+def template_dependencies(contents):
+    """
+    Returns the names of the templates ``contents`` extends or includes by
+    name. Names computed from variables can't be known, and are left out.
+    """
+    contents = COMMENT_RE.sub('', contents)
+    return frozenset(
+        posixpath.normpath(match.group('name'))
+        for match in DEPENDENCY_RE.finditer(contents)
+    )
+
+
+def read_dependencies(theme, template_name):
+    path = posixpath.join(theme.path, 'templates', template_name)
+    text = read_text(default_theme_storage, path, limit=SCAN_LIMIT)
+    if text.binary:
+        return frozenset()
+    return template_dependencies(text.contents)
+
+
+def build_dependencies(theme):
+    manifest = get_template_manifests([theme])[theme.pk]
+    return dict(
+        (name, read_dependencies(theme, name))
+        for name in manifest
+    )
+
+
+def get_dependencies(themes):
+    """
+    Returns a dictionary mapping the pk of each of ``themes`` to its
+    dependency index, building any that isn't cached yet.
+    """
+    return get_manifests(themes, dependency_cache_key, build_dependencies)
+
+
+def get_used_by(themes, template_name):
+    """
+    Returns ``(theme, name)`` for every template in ``themes`` that extends
+    or includes ``template_name`` directly.
+    """
+    template_name = posixpath.normpath(template_name)
+    indexes = get_dependencies(themes)
+    return [
+        (theme, name)
+        for theme in themes
+        for name, dependencies in sorted(indexes[theme.pk].items())
+        if template_name in dependencies
+    ]
+
+
+def get_dependents(themes, template_names):
+    """
+    Returns the names of the templates in any of ``themes`` that depend on
+    any of ``template_names``, directly or through other templates. Themes
+    are looked at together, as a template in one theme can extend one that
+    only exists in another.
+    """
+    used_by = {}
+    for index in get_dependencies(themes).values():
+        for name, dependencies in index.items():
+            for dependency in dependencies:
+                used_by.setdefault(dependency, set()).add(name)
+
+    dependents = set()
+    pending = [posixpath.normpath(name) for name in template_names]
+    while pending:
+        for name in used_by.get(pending.pop(), ()):
+            if name not in dependents:
+                dependents.add(name)
+                pending.append(name)
+    return dependents
+
+
+def update_dependencies(theme, path):
+    """
+    Records that the file at ``path``, relative to the root of ``theme``, was
+    written or deleted.
+    """
+    path = posixpath.normpath(path.strip('/'))
+    if not path.startswith('templates/'):
+        return
+    template_name = path[len('templates/'):]
+
+    key = dependency_cache_key(theme)
+    index = cache.get(key)
+    if index is None:
+        return
+
+    index = dict(index)
+    if default_theme_storage.exists(posixpath.join(theme.path, path)):
+        index[template_name] = read_dependencies(theme, template_name)
+    else:
+        index.pop(template_name, None)
+    cache.set(key, index, MANIFEST_TIMEOUT)
+
+
+def changed_templates(path):
+    """
+    Returns the names of the templates to drop from template caches when the
+    file at ``path``, relative to the root of a theme, changes: the template
+    itself and every template that depends on it, in any theme.
+    """
+    from django_themes.registry import get_snapshot
+
+    path = posixpath.normpath(path.strip('/'))
+    if not path.startswith('templates/'):
+        return frozenset()
+    template_name = path[len('templates/'):]
+    themes = list(get_snapshot().themes.values())
+    return frozenset([template_name]) | frozenset(get_dependents(themes, [template_name]))
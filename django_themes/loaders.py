@@ -2,16 +2,21 @@
 Wrapper for loading templates from themes.
 """
 import errno
+import threading
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import SuspiciousFileOperation
-from django.db.models import Q
-from django.template import Origin, TemplateDoesNotExist
+from django.db.models import signals
+from django.template import Origin, Template, TemplateDoesNotExist
 from django.utils._os import safe_join
 
-from django_themes.storage import default_theme_storage
+from django_themes import registry
+from django_themes.manifest import get_template_manifests
+from django_themes.metrics import increment, timer
+from django_themes.storage import default_theme_storage, get_modified_time
 from django_themes.models import Theme
+from django_themes.utils import LRUCache
 
 from django.template.loaders.base import Loader as BaseLoader
 import posixpath
@@ -22,6 +27,69 @@ import logging
 logger = logging.getLogger(__name__)
 logger.debug("Logging started for " + __name__)
 
+# Maps ``(theme set fingerprint, template name, skipped theme pks)`` to the
+# ``(origin, contents, tried)`` found for it. Misses are cached too, with
+# ``origin`` set to ``None``. Entries for templates that changed are dropped
+# by ``sync_template_cache`` when the registry generation moves on.
+resolved_templates = LRUCache(getattr(settings, 'THEMES_TEMPLATE_CACHE_SIZE', 1000))
+
+# Maps the same keys to ``(template, modified time)`` for compiled templates,
+# used by ``CachedThemeTemplateLoader``.
+compiled_templates = LRUCache(getattr(settings, 'THEMES_TEMPLATE_CACHE_SIZE', 1000))
+
+
+def invalidate_template_cache(**kwargs):
+    """
+    Forget every template resolved or compiled in this process, so the next
+    lookup goes back to the database and theme storage.
+    """
+    resolved_templates.clear()
+    compiled_templates.clear()
+
+
+signals.post_save.connect(invalidate_template_cache, sender=Theme, dispatch_uid="django_themes_loader_theme_saved")
+signals.post_delete.connect(invalidate_template_cache, sender=Theme, dispatch_uid="django_themes_loader_theme_deleted")
+
+_synced_generation = None
+_sync_lock = threading.Lock()
+
+
+def sync_template_cache(generation):
+    """
+    Brings this process's template caches up to date with ``generation``,
+    dropping only the templates, or the themes, that changed since the last
+    generation seen here when the registry knows which those are, or
+    everything if not. The in-process tier of a ``CachedStorage`` is cleared
+    too, as files changed by other processes were only dropped from theirs.
+    """
+    global _synced_generation
+    if _synced_generation == generation:
+        return
+    with _sync_lock:
+        since = _synced_generation
+        if since == generation:
+            return
+        invalidations = None
+        if since is not None:
+            invalidations = registry.get_invalidations(since, generation)
+            clear_local = getattr(default_theme_storage, 'clear_local', None)
+            if clear_local is not None:
+                clear_local()
+        if invalidations is None:
+            invalidate_template_cache()
+        elif invalidations[0] or invalidations[1]:
+            templates, themes = invalidations
+
+            def is_changed(key):
+                fingerprint, template_name, skipped = key
+                return (
+                    posixpath.normpath(template_name) in templates or
+                    any(theme.pk in themes for theme in fingerprint)
+                )
+            resolved_templates.delete_matching(is_changed)
+            compiled_templates.delete_matching(is_changed)
+        _synced_generation = generation
+
 
 class ThemeTemplateLoader(BaseLoader):
 
@@ -30,27 +98,36 @@ class ThemeTemplateLoader(BaseLoader):
         path = posixpath.normpath(posixpath.join(theme.path, 'templates', template_name))
         return path
 
-    def get_themes(self):
-        from django_themes.middleware import get_current_user_key
-        from django_themes.utils import get_previewing_themes
-        user_key = get_current_user_key()
-        
-        preview_pks = []
-        if user_key is not None:
-            preview_pks = get_previewing_themes(user_key)
-        logger.debug("previewing", user_key, preview_pks)
-            
-        return Theme.objects.all().filter(Q(is_active=True) | Q(pk__in=preview_pks)).order_by('-order')
+    def get_themes(self, snapshot=None):
+        """
+        Returns the ordered ``ThemeEntry`` tuple for the active themes, plus
+        any the current user is previewing, from the shared theme registry.
+        """
+        return registry.get_current_themes(snapshot=snapshot)
+
+    def get_theme_set_fingerprint(self, themes):
+        """
+        Returns a hashable value that changes whenever the themes used to
+        resolve a template, or their order, change. Changes to the files in
+        them are handled by ``sync_template_cache``.
+        """
+        return tuple(themes)
 
     def get_contents(self, origin):
         try:
             # with open(origin.name, encoding=self.engine.file_charset) as fp:
             path = self.get_theme_template_path(origin.loader, origin.template_name)
-            with default_theme_storage.open(path) as fp:
-                logger.debug("serving -- %s::%s" % (origin.loader.path, origin.template_name))
-                return fp.read()
+            increment('storage.opens')
+            with timer('theme-storage'):
+                with default_theme_storage.open(path) as fp:
+                    logger.debug("serving -- %s::%s" % (origin.loader.path, origin.template_name))
+                    contents = fp.read()
+            if isinstance(contents, bytes):
+                contents = contents.decode(self.engine.file_charset)
+            return contents
         except IOError as e:
             if e.errno == errno.ENOENT:
+                increment('storage.misses')
                 raise TemplateDoesNotExist(origin)
             raise
 
@@ -66,3 +143,115 @@ class ThemeTemplateLoader(BaseLoader):
                 template_name=template_name,
                 loader=theme
             )
+
+    def find_template(self, template_name, themes, skip=None):
+        """
+        Walks ``themes`` in order and returns ``(origin, contents, tried)`` for
+        the first one that holds ``template_name``. If none do, ``origin`` and
+        ``contents`` are ``None``.
+        """
+        tried = []
+        manifests = get_template_manifests(themes)
+        manifest_name = posixpath.normpath(template_name)
+        for theme in themes:
+            origin = Origin(
+                name=template_name,
+                template_name=template_name,
+                loader=theme
+            )
+            if skip is not None and origin in skip:
+                tried.append((origin, 'Skipped'))
+                continue
+            if manifest_name not in manifests[theme.pk]:
+                tried.append((origin, 'Source does not exist'))
+                continue
+            try:
+                contents = self.get_contents(origin)
+            except TemplateDoesNotExist:
+                tried.append((origin, 'Source does not exist'))
+                continue
+            increment('loader.theme_hits', theme=theme.pk)
+            return origin, contents, tried
+        return None, None, tried
+
+    def get_template(self, template_name, template_dirs=None, skip=None):
+        """
+        Resolves ``template_name`` against the current theme set, reusing the
+        result of an earlier lookup for the same theme set where possible.
+        """
+        with timer('theme-resolve'):
+            snapshot = registry.get_current_snapshot()
+            sync_template_cache(snapshot.generation)
+            themes = self.get_themes(snapshot)
+            key = self.get_cache_key(template_name, themes, skip)
+            return self.load_template(key, template_name, themes, skip)
+
+    def get_cache_key(self, template_name, themes, skip=None):
+        skipped = tuple(
+            origin.loader.pk for origin in skip or []
+            if isinstance(origin.loader, registry.ThemeEntry) and origin.name == template_name
+        )
+        return (self.get_theme_set_fingerprint(themes), template_name, skipped)
+
+    def load_template(self, key, template_name, themes, skip=None):
+        resolved = resolved_templates.get(key)
+        if resolved is None:
+            increment('loader.resolved.misses')
+            resolved = self.find_template(template_name, themes, skip)
+            resolved_templates.set(key, resolved)
+        else:
+            increment('loader.resolved.hits')
+
+        origin, contents, tried = resolved
+        if origin is None:
+            raise TemplateDoesNotExist(template_name, tried=tried)
+        return Template(contents, origin, origin.template_name, self.engine)
+
+
+class CachedThemeTemplateLoader(ThemeTemplateLoader):
+    """
+    A ``ThemeTemplateLoader`` that also keeps compiled templates, like
+    Django's ``cached.Loader``, but keyed on the theme set so a preview never
+    leaks into another user's pages.
+
+    Use it in place of ``ThemeTemplateLoader`` rather than wrapping it in
+    ``cached.Loader``. With ``THEMES_TEMPLATE_CHECK_MODIFIED_TIME`` (which
+    defaults to ``DEBUG``) each cached template is checked against its
+    modified time in storage, so edits show up right away.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachedThemeTemplateLoader, self).__init__(*args, **kwargs)
+        self.check_modified_time = getattr(
+            settings, 'THEMES_TEMPLATE_CHECK_MODIFIED_TIME', settings.DEBUG
+        )
+
+    def get_modified_time(self, origin):
+        path = self.get_theme_template_path(origin.loader, origin.template_name)
+        try:
+            return get_modified_time(default_theme_storage, path)
+        except (IOError, OSError):
+            return None
+
+    def load_template(self, key, template_name, themes, skip=None):
+        cached = compiled_templates.get(key)
+        if cached is not None:
+            template, modified_time = cached
+            if not self.check_modified_time:
+                increment('loader.compiled.hits')
+                return template
+            if modified_time is not None and modified_time == self.get_modified_time(template.origin):
+                increment('loader.compiled.hits')
+                return template
+            resolved_templates.delete(key)
+        increment('loader.compiled.misses')
+
+        template = super(CachedThemeTemplateLoader, self).load_template(key, template_name, themes, skip)
+        modified_time = None
+        if self.check_modified_time:
+            modified_time = self.get_modified_time(template.origin)
+        compiled_templates.set(key, (template, modified_time))
+        return template
+
+    def reset(self):
+        invalidate_template_cache()
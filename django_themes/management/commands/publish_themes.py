@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_themes.manifest import reset_manifests
+from django_themes.models import Theme
+from django_themes.publish import publish_theme
+from django_themes.registry import bump_generation
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes a manifest and pre-compressed copies of the files in each theme. "
+        "Only files whose contents changed since the last publish are rewritten."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'theme_ids', nargs='*', type=int,
+            help="Primary keys of the themes to publish, defaults to every theme."
+        )
+        parser.add_argument(
+            '--force', action='store_true', dest='force', default=False,
+            help="Re-read and re-compress every file, even if it looks unchanged."
+        )
+
+    def handle(self, *args, **options):
+        themes = Theme.objects.all()
+        if options['theme_ids']:
+            themes = themes.filter(pk__in=options['theme_ids'])
+            missing = set(options['theme_ids']) - set(theme.pk for theme in themes)
+            if missing:
+                raise CommandError("No themes with ids: %s" % ", ".join(map(str, sorted(missing))))
+
+        for theme in themes:
+            manifest, changed = publish_theme(theme, force=options['force'])
+            # Manifests built by walking storage are replaced by ones read
+            # from the newly published manifest.
+            reset_manifests(theme)
+            self.stdout.write(
+                "Published %s: %d files, %d rewritten" % (theme, len(manifest['files']), len(changed))
+            )
+        bump_generation()
@@ -0,0 +1,33 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from django_themes.watcher import InotifyObserver, PollingObserver, ThemeWatcher, get_watch_root, inotify_simple
+
+
+class Command(BaseCommand):
+    help = (
+        "Watches THEMES_FILE_ROOT for files changed outside of the admin, and invalidates "
+        "the caches of the themes they belong to in every worker. Run one per server."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--poll', action='store_true', dest='poll', default=False,
+            help="Poll for changes even if inotify is available."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            root = get_watch_root()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        if inotify_simple is not None and not options['poll']:
+            observer = InotifyObserver(root)
+        else:
+            observer = PollingObserver(root)
+        self.stdout.write("Watching %s with %s" % (root, observer.__class__.__name__))
+        try:
+            ThemeWatcher(root, observer=observer).run()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,195 @@
+"""
+Per-theme manifests of the files that exist in theme storage.
+
+The loader checks a theme's template manifest before opening a template, so a
+template that only exists in a low ranked theme doesn't cost a failed storage
+read for every theme ranked above it. Static manifests map each file under
+``<theme.path>/static`` to a hash of its contents, for use in cache-busting
+URLs. Both are taken from the published manifest when a theme has one.
+"""
+import hashlib
+import posixpath
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_themes.metrics import increment
+from django_themes.publish import get_published_manifest
+from django_themes.storage import default_theme_storage, walk_storage
+from django_themes.utils import THEME_CACHE_KEY_PREFIX
+
+# Manifests are rebuilt from storage this often, so files written without
+# going through the admin are picked up.
+MANIFEST_TIMEOUT = getattr(settings, 'THEMES_TEMPLATE_MANIFEST_TIMEOUT', 5 * 60)
+# How long a manifest update may hold its lock, in seconds.
+MANIFEST_LOCK_TIMEOUT = 10
+DIGEST_LENGTH = 12
+
+
+def manifest_cache_key(theme):
+    return "%smanifest-%s-%s" % (THEME_CACHE_KEY_PREFIX, theme.pk, theme.path)
+
+
+def static_manifest_cache_key(theme):
+    return "%sstatic-manifest-%s-%s" % (THEME_CACHE_KEY_PREFIX, theme.pk, theme.path)
+
+
+def dependency_cache_key(theme):
+    return "%sdependencies-%s-%s" % (THEME_CACHE_KEY_PREFIX, theme.pk, theme.path)
+
+
+def published_files(theme, folder):
+    """
+    Returns the files below ``folder`` from the published manifest of
+    ``theme``, keyed by their path within ``folder``, or ``None`` if the
+    theme hasn't been published.
+    """
+    published = get_published_manifest(theme)
+    if published is None:
+        return None
+    prefix = folder + '/'
+    return dict(
+        (path[len(prefix):], entry)
+        for path, entry in published['files'].items()
+        if path.startswith(prefix)
+    )
+
+
+def build_template_manifest(theme):
+    published = published_files(theme, 'templates')
+    if published is not None:
+        return frozenset(published)
+    templates_path = posixpath.join(theme.path, 'templates')
+    return frozenset(walk_storage(default_theme_storage, templates_path))
+
+
+def file_digest(storage, path):
+    md5 = hashlib.md5()
+    with storage.open(path) as fh:
+        for chunk in fh.chunks():
+            md5.update(chunk)
+    return md5.hexdigest()[:DIGEST_LENGTH]
+
+
+def build_static_manifest(theme):
+    published = published_files(theme, 'static')
+    if published is not None:
+        return dict(
+            (name, entry['hash'][:DIGEST_LENGTH])
+            for name, entry in published.items()
+        )
+    static_path = posixpath.join(theme.path, 'static')
+    return dict(
+        (name, file_digest(default_theme_storage, posixpath.join(static_path, name)))
+        for name in walk_storage(default_theme_storage, static_path)
+    )
+
+
+def get_manifests(themes, cache_key, build, rebuild=False):
+    keys = dict((cache_key(theme), theme) for theme in themes)
+    cached = {} if rebuild else cache.get_many(list(keys))
+    increment('manifest.hits', len(cached))
+    increment('manifest.misses', len(keys) - len(cached))
+
+    manifests = {}
+    for key, theme in keys.items():
+        manifest = cached.get(key)
+        if manifest is None:
+            manifest = build(theme)
+            if rebuild:
+                cache.set(key, manifest, MANIFEST_TIMEOUT)
+            else:
+                # Doesn't overwrite a manifest a file change updated meanwhile.
+                cache.add(key, manifest, MANIFEST_TIMEOUT)
+        manifests[theme.pk] = manifest
+    return manifests
+
+
+def get_template_manifests(themes, rebuild=False):
+    """
+    Returns a dictionary mapping the pk of each of ``themes`` to the set of
+    template names it holds, building any manifest that isn't cached yet, or
+    all of them from storage if ``rebuild`` is set.
+    """
+    return get_manifests(themes, manifest_cache_key, build_template_manifest, rebuild)
+
+
+def get_static_manifests(themes):
+    """
+    Returns a dictionary mapping the pk of each of ``themes`` to a dictionary
+    of its static file names and their content digests.
+    """
+    return get_manifests(themes, static_manifest_cache_key, build_static_manifest)
+
+
+def reset_manifests(theme):
+    """
+    Drops the cached manifests of ``theme``, for when its files were changed
+    all at once rather than one at a time through the admin.
+    """
+    cache.delete_many([
+        manifest_cache_key(theme), static_manifest_cache_key(theme), dependency_cache_key(theme)
+    ])
+
+
+def update_manifest(key, change):
+    """
+    Replaces the cached manifest at ``key`` with ``change(manifest)``. Updates
+    take a lock, so two files changed at once can't drop each other's entry.
+    If the lock can't be had the manifest is dropped instead, and rebuilt from
+    storage by the next lookup.
+    """
+    lock_key = key + '-lock'
+    if not cache.add(lock_key, 1, MANIFEST_LOCK_TIMEOUT):
+        cache.delete(key)
+        return
+    try:
+        manifest = cache.get(key)
+        if manifest is None:
+            # Nothing cached yet, the next lookup will build it from storage.
+            return
+        cache.set(key, change(manifest), MANIFEST_TIMEOUT)
+    finally:
+        cache.delete(lock_key)
+
+
+def update_template_manifest(theme, path):
+    """
+    Records that the file at ``path``, relative to the root of ``theme``, was
+    written or deleted.
+    """
+    path = posixpath.normpath(path.strip('/'))
+    if not path.startswith('templates/'):
+        return
+    template_name = frozenset([path[len('templates/'):]])
+
+    if default_theme_storage.exists(posixpath.join(theme.path, path)):
+        change = lambda manifest: manifest | template_name
+    else:
+        change = lambda manifest: manifest - template_name
+    update_manifest(manifest_cache_key(theme), change)
+
+
+def update_static_manifest(theme, path):
+    """
+    Records that the file at ``path``, relative to the root of ``theme``, was
+    written or deleted, updating its digest.
+    """
+    path = posixpath.normpath(path.strip('/'))
+    if not path.startswith('static/'):
+        return
+    name = path[len('static/'):]
+
+    full_path = posixpath.join(theme.path, path)
+    digest = None
+    if default_theme_storage.exists(full_path):
+        digest = file_digest(default_theme_storage, full_path)
+
+    def change(manifest):
+        manifest = dict(manifest)
+        if digest is None:
+            manifest.pop(name, None)
+        else:
+            manifest[name] = digest
+        return manifest
+    update_manifest(static_manifest_cache_key(theme), change)
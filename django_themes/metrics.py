@@ -0,0 +1,149 @@
+"""
+Counters and timings for theme resolution.
+
+Each metric goes to a collector, which is ``MemoryCollector`` unless
+``THEMES_METRICS_COLLECTOR`` names another class with the same ``increment``
+and ``timing`` methods (to feed statsd or Prometheus, say). Within a request
+they are also totalled per request, for the ``Server-Timing`` header added by
+``PreviewWithCurrentUserMiddleware``.
+
+Timings, in seconds:
+
+``theme-resolve``
+    Finding and compiling a template with the theme loader, in total.
+``theme-registry``
+    Building the registry snapshot from the database.
+``theme-storage``
+    Reading template files from theme storage.
+
+Counters:
+
+``registry.queries``, ``storage.opens``, ``storage.misses``, and hits and
+misses of the ``loader.resolved``, ``loader.compiled`` and ``manifest``
+caches, plus ``loader.theme_hits`` tagged with the ``theme`` that held each
+template found.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from django_themes.middleware import get_request_memo
+
+METRICS_ENABLED = getattr(settings, 'THEMES_METRICS', True)
+
+_collector = None
+
+
+class MemoryCollector(object):
+    """
+    Keeps totals for every counter and timing in memory, per combination of
+    tags, for as long as the process runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def increment(self, name, value=1, tags=None):
+        key = (name, tuple(sorted((tags or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, seconds, tags=None):
+        key = (name, tuple(sorted((tags or {}).items())))
+        with self.lock:
+            count, total, longest = self.timings.get(key, (0, 0.0, 0.0))
+            self.timings[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    def get_counter(self, name, **tags):
+        return self.counters.get((name, tuple(sorted(tags.items()))), 0)
+
+    def hit_ratio(self, name):
+        """
+        Returns the share of lookups of the ``name`` cache that were hits,
+        or ``None`` if there were none.
+        """
+        hits = self.get_counter(name + '.hits')
+        lookups = hits + self.get_counter(name + '.misses')
+        if not lookups:
+            return None
+        return hits / float(lookups)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+def get_collector():
+    global _collector
+    if _collector is None:
+        path = getattr(settings, 'THEMES_METRICS_COLLECTOR', None)
+        _collector = import_string(path)() if path else MemoryCollector()
+    return _collector
+
+
+def get_request_metrics():
+    """
+    Returns ``(counters, timings)`` for the current request, where timings
+    map names to ``[count, total seconds]``, or ``None`` outside a request.
+    """
+    memo = get_request_memo()
+    if memo is None:
+        return None
+    if 'metrics' not in memo:
+        memo['metrics'] = ({}, {})
+    return memo['metrics']
+
+
+def increment(name, value=1, **tags):
+    if not METRICS_ENABLED:
+        return
+    get_collector().increment(name, value, tags)
+    metrics = get_request_metrics()
+    if metrics is not None:
+        metrics[0][name] = metrics[0].get(name, 0) + value
+
+
+def record_timing(name, seconds, **tags):
+    if not METRICS_ENABLED:
+        return
+    get_collector().timing(name, seconds, tags)
+    metrics = get_request_metrics()
+    if metrics is not None:
+        timing = metrics[1].setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+
+
+@contextmanager
+def timer(name, **tags):
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_timing(name, time.time() - start, **tags)
+
+
+def server_timing_header():
+    """
+    Returns a ``Server-Timing`` header value for the timings recorded during
+    the current request, or ``None`` if there were none.
+    """
+    memo = get_request_memo()
+    if not memo or 'metrics' not in memo:
+        return None
+    timings = memo['metrics'][1]
+    if not timings:
+        return None
+    return ", ".join(
+        '%s;dur=%.3f;desc="%d calls"' % (name, total * 1000, count)
+        for name, (count, total) in sorted(timings.items())
+    )
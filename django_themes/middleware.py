@@ -1,24 +1,134 @@
+"""
+Per-request state for theme resolution, kept in context variables so it
+follows a request through threads and coroutines under both WSGI and ASGI.
+"""
 from __future__ import absolute_import, division, print_function
 
+import asyncio
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import DisallowedHost
+from django.http.request import split_domain_port
+from django.utils.cache import patch_cache_control
+
 try:
-    from threading import local
+    from asgiref.sync import markcoroutinefunction
 except ImportError:
-    from django.utils._threading_local import local
+    markcoroutinefunction = None
+
+_current_request = ContextVar('django_themes_current_request', default=None)
+_request_memo = ContextVar('django_themes_request_memo', default=None)
+
+THEME_SET_HEADER = getattr(settings, 'THEMES_THEME_SET_HEADER', 'X-Theme-Set')
+SERVER_TIMING = getattr(settings, 'THEMES_SERVER_TIMING', settings.DEBUG)
 
-_thread_locals = local()
 
 def get_current_user_key():
-    """ returns the request object for this thread """
-    return getattr(_thread_locals, "current_user_key", None)
+    """ returns the primary key of the user making the current request """
+    request = _current_request.get()
+    user = getattr(request, 'user', None)
+    if user is None:
+        return None
+    return user.pk
 
-class PreviewWithCurrentUserMiddleware(object):
-    """ Simple middleware that adds the request object in thread local storage."""
 
-    def process_request(self, request):
-        if hasattr(request, 'user'):
-            _thread_locals.current_user_key = request.user.pk
+def get_current_host():
+    """ returns the host name, without the port, of the current request """
+    request = _current_request.get()
+    if request is None:
+        return None
+    try:
+        host = request.get_host()
+    except DisallowedHost:
+        return None
+    return split_domain_port(host)[0] or None
+
 
-    def process_response(self, request, response):
-        if hasattr(_thread_locals, 'request'):
-            del _thread_locals.request
+def get_request_memo():
+    """
+    Returns a dict that lives as long as the current request, for values
+    worked out once per request, or ``None`` outside of a request.
+    """
+    return _request_memo.get()
+
+
+def tag_response(response):
+    """
+    Adds the fingerprint of the themes used for the current request to
+    ``response``, if any theme lookups were made while handling it. Responses
+    for users previewing themes are marked private, so shared caches never
+    hand them to anyone else. With ``THEMES_SERVER_TIMING`` on, the time
+    spent resolving themes is added in a ``Server-Timing`` header.
+    """
+    memo = get_request_memo()
+    if SERVER_TIMING and memo and 'metrics' in memo:
+        from django_themes.metrics import server_timing_header
+
+        timing = server_timing_header()
+        if timing:
+            existing = response.get('Server-Timing')
+            response['Server-Timing'] = "%s, %s" % (existing, timing) if existing else timing
+    if not THEME_SET_HEADER or not memo or 'snapshot' not in memo:
         return response
+    from django_themes.registry import get_current_fingerprint
+
+    fingerprint, previewing = get_current_fingerprint()
+    response[THEME_SET_HEADER] = fingerprint
+    if previewing:
+        patch_cache_control(response, private=True)
+    return response
+
+
+def enter_request(request):
+    """
+    Makes ``request`` the current one, returning the tokens to pass to
+    ``exit_request`` once it has been handled.
+    """
+    return _current_request.set(request), _request_memo.set({})
+
+
+def exit_request(tokens):
+    request_token, memo_token = tokens
+    _request_memo.reset(memo_token)
+    _current_request.reset(request_token)
+
+
+class PreviewWithCurrentUserMiddleware(object):
+    """
+    Makes the current request available to theme lookups, so users see the
+    themes they are previewing. Works as both sync and async middleware.
+
+    The user is only looked up when a template or static file is resolved,
+    so async middleware never touches the session or database itself.
+
+    Responses that used themes get a header (``X-Theme-Set`` by default, see
+    ``THEMES_THEME_SET_HEADER``) naming the theme set they were rendered with.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            if markcoroutinefunction is not None:
+                markcoroutinefunction(self)
+            else:
+                self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        tokens = enter_request(request)
+        try:
+            return tag_response(self.get_response(request))
+        finally:
+            exit_request(tokens)
+
+    async def __acall__(self, request):
+        tokens = enter_request(request)
+        try:
+            return tag_response(await self.get_response(request))
+        finally:
+            exit_request(tokens)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_themes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThemeBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.BigIntegerField()),
+                ('data', models.BinaryField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ThemeFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=512, unique=True)),
+                ('folder', models.CharField(db_index=True, max_length=512)),
+                ('size', models.BigIntegerField()),
+                ('modified_at', models.DateTimeField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='files', to='django_themes.ThemeBlob')),
+            ],
+        ),
+    ]
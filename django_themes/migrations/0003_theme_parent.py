@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_themes', '0002_themeblob_themefile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='theme',
+            name='parent',
+            field=models.ForeignKey(blank=True, help_text="Files not in this theme are looked for in its parent, and then the parent's parent, and so on.", null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='children', to='django_themes.Theme', verbose_name='parent'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_themes', '0003_theme_parent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='theme',
+            name='hosts',
+            field=models.TextField(blank=True, help_text='Host names this theme is used for, one per line. *.example.com matches every subdomain of example.com. Leave empty to use it for every host.', verbose_name='hosts'),
+        ),
+    ]
@@ -1,10 +1,14 @@
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from django.db.models import signals
 from django.template import TemplateDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 
 from django.utils.timezone import now
 
+from django_themes.signals import theme_file_changed
+from django_themes.utils import host_patterns
+
 
 class Theme(models.Model):
     """
@@ -40,9 +44,16 @@ class Theme(models.Model):
         help_text=_("A brief description of the files in this theme."),
         blank=True
     )
+    parent = models.ForeignKey(
+        'self', verbose_name=_('parent'), null=True, blank=True,
+        on_delete=models.SET_NULL, related_name='children',
+        help_text=_("Files not in this theme are looked for in its parent, and then the parent's parent, and so on.")
+    )
+    hosts = models.TextField(
+        _('hosts'), blank=True,
+        help_text=_("Host names this theme is used for, one per line. *.example.com matches every subdomain of example.com. Leave empty to use it for every host.")
+    )
     # content = models.TextField(_('content'), blank=True)
-    # sites = models.ManyToManyField(Site, verbose_name=_(u'sites'),
-    #                               blank=True)
     # subthemes = models.ManyToManyField('self', verbose_name=_(u'sites'),
     #                               blank=True)
 
@@ -50,4 +61,77 @@ class Theme(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+    def clean(self):
+        seen = set([self.pk])
+        parent = self.parent
+        while parent is not None:
+            if parent.pk in seen:
+                raise ValidationError({
+                    'parent': _("A theme can't inherit from itself, directly or through its parents.")
+                })
+            seen.add(parent.pk)
+            parent = parent.parent
+
+        for pattern in host_patterns(self.hosts):
+            if '*' in pattern.lstrip('*') or (pattern.startswith('*') and not pattern.startswith('*.')):
+                raise ValidationError({
+                    'hosts': _("%(pattern)s isn't a host name or a pattern like *.example.com.") % {'pattern': pattern}
+                })
+
+
+class ThemeBlob(models.Model):
+    """
+    The contents of a file kept by ``DatabaseStorage``. Blobs are keyed by
+    the SHA-256 of their contents, so identical files share one blob.
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    data = models.BinaryField()
+
+    def __str__(self):
+        return self.hash
+
+
+class ThemeFile(models.Model):
+    """
+    A file kept by ``DatabaseStorage``, at ``name`` relative to the root of
+    theme storage. ``folder`` is the folder holding it, so listing a folder
+    is a single indexed query.
+    """
+    name = models.CharField(max_length=512, unique=True)
+    folder = models.CharField(max_length=512, db_index=True)
+    blob = models.ForeignKey(ThemeBlob, on_delete=models.PROTECT, related_name='files')
+    size = models.BigIntegerField()
+    modified_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+
+def theme_registry_changed(sender, **kwargs):
+    from django_themes.registry import bump_generation
+    # Wait for the commit, so other workers can't rebuild the registry from
+    # rows that are about to change.
+    transaction.on_commit(bump_generation)
+
+
+signals.post_save.connect(theme_registry_changed, sender=Theme, dispatch_uid="django_themes_registry_theme_saved")
+signals.post_delete.connect(theme_registry_changed, sender=Theme, dispatch_uid="django_themes_registry_theme_deleted")
+
+
+def theme_file_manifest_changed(sender, theme, path, **kwargs):
+    from django_themes.dependencies import changed_templates, update_dependencies
+    from django_themes.manifest import update_static_manifest, update_template_manifest
+    from django_themes.publish import update_published_file
+    from django_themes.registry import bump_generation
+    update_published_file(theme, path)
+    update_template_manifest(theme, path)
+    update_static_manifest(theme, path)
+    update_dependencies(theme, path)
+    invalidated = changed_templates(path)
+    transaction.on_commit(lambda: bump_generation(invalidated_templates=invalidated))
+
+
+theme_file_changed.connect(theme_file_manifest_changed, dispatch_uid="django_themes_manifest_file_changed")
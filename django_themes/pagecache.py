@@ -0,0 +1,55 @@
+"""
+Django's cache middleware, with the theme set of each request in its cache
+key, so users who see the same themes share cached pages while users
+previewing other themes get entries of their own.
+
+Use these in place of the ones in ``django.middleware.cache``, with
+``PreviewWithCurrentUserMiddleware`` listed before
+``UpdateCacheMiddleware`` so the current request is known to both::
+
+    MIDDLEWARE = [
+        'django_themes.middleware.PreviewWithCurrentUserMiddleware',
+        'django_themes.pagecache.UpdateCacheMiddleware',
+        ...
+        'django_themes.pagecache.FetchFromCacheMiddleware',
+    ]
+"""
+from django.middleware import cache
+
+from django_themes.middleware import get_request_memo
+from django_themes.registry import get_current_fingerprint
+
+
+def theme_cache_key_prefix(key_prefix):
+    """
+    Returns ``key_prefix`` extended with the fingerprint of the current
+    request's themes. Use it to build a ``key_prefix`` for Django's
+    ``get_cache_key`` and ``learn_cache_key`` in custom page caching.
+    """
+    if get_request_memo() is None:
+        return key_prefix
+    fingerprint, previewing = get_current_fingerprint()
+    return "%s.themes.%s" % (key_prefix, fingerprint)
+
+
+class ThemeKeyPrefixMixin(object):
+
+    @property
+    def key_prefix(self):
+        return theme_cache_key_prefix(self.base_key_prefix)
+
+    @key_prefix.setter
+    def key_prefix(self, value):
+        self.base_key_prefix = value
+
+
+class UpdateCacheMiddleware(ThemeKeyPrefixMixin, cache.UpdateCacheMiddleware):
+    pass
+
+
+class FetchFromCacheMiddleware(ThemeKeyPrefixMixin, cache.FetchFromCacheMiddleware):
+    pass
+
+
+class CacheMiddleware(ThemeKeyPrefixMixin, cache.CacheMiddleware):
+    pass
@@ -0,0 +1,208 @@
+"""
+Publishing themes: a manifest of every file in a theme, plus pre-compressed
+copies of its text files.
+
+Everything is written under ``<theme.path>/.published``. The manifest records
+the size, modified time and md5 hash of each file, so runtime lookups and the
+admin can read one file instead of listing and reading remote storage, and so
+the next publish only rewrites files whose contents changed.
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import posixpath
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_themes.storage import default_theme_storage, get_modified_time, replace_file, walk_storage
+from django_themes.utils import THEME_CACHE_KEY_PREFIX
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PUBLISH_DIR = '.published'
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+COMPRESS_MIN_SIZE = getattr(settings, 'THEMES_COMPRESS_MIN_SIZE', 256)
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+)
+ENCODING_EXTENSIONS = {
+    'gzip': '.gz',
+    'br': '.br',
+}
+
+
+def published_path(theme, path):
+    return posixpath.join(theme.path, PUBLISH_DIR, path)
+
+
+def published_manifest_cache_key(theme):
+    return "%spublished-%s-%s" % (THEME_CACHE_KEY_PREFIX, theme.pk, theme.path)
+
+
+def get_published_manifest(theme):
+    """
+    Returns the published manifest for ``theme`` as a dictionary, or ``None``
+    if the theme has never been published.
+    """
+    key = published_manifest_cache_key(theme)
+    manifest = cache.get(key)
+    if manifest is None:
+        name = published_path(theme, MANIFEST_NAME)
+        if default_theme_storage.exists(name):
+            with default_theme_storage.open(name) as fh:
+                manifest = json.loads(fh.read().decode('utf-8'))
+        else:
+            manifest = {}
+        cache.set(key, manifest, None)
+    return manifest or None
+
+
+def write_published_manifest(theme, manifest):
+    content = json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8')
+    replace_file(default_theme_storage, published_path(theme, MANIFEST_NAME), content)
+    cache.set(published_manifest_cache_key(theme), manifest, None)
+
+
+def is_compressible(path):
+    content_type, encoding = mimetypes.guess_type(path)
+    if content_type is None or encoding is not None:
+        return False
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+
+def compress(content):
+    """
+    Returns a dictionary of every encoding worth using for ``content``, mapped
+    to the encoded bytes.
+    """
+    variants = {}
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as fh:
+        fh.write(content)
+    variants['gzip'] = buf.getvalue()
+    if brotli is not None:
+        variants['br'] = brotli.compress(content)
+    return dict(
+        (encoding, data) for encoding, data in variants.items()
+        if len(data) < len(content)
+    )
+
+
+def read_file(storage, name):
+    with storage.open(name) as fh:
+        return fh.read()
+
+
+def delete_variants(theme, path, encodings):
+    for encoding in encodings:
+        variant_name = published_path(theme, path + ENCODING_EXTENSIONS[encoding])
+        if default_theme_storage.exists(variant_name):
+            default_theme_storage.delete(variant_name)
+
+
+def publish_file(theme, path, previous=None, force=False):
+    """
+    Returns the manifest entry for the file at ``path`` in ``theme``, along
+    with whether its compressed copies were rewritten. If the size and
+    modified time match ``previous``, the file isn't read at all.
+    """
+    storage = default_theme_storage
+    name = posixpath.join(theme.path, path)
+    size = storage.size(name)
+    modified = get_modified_time(storage, name).isoformat()
+
+    if not force and previous and previous['size'] == size and previous['modified'] == modified:
+        return previous, False
+
+    content = read_file(storage, name)
+    entry = {
+        'size': size,
+        'modified': modified,
+        'hash': hashlib.md5(content).hexdigest(),
+        'encodings': [],
+    }
+    if not force and previous and previous['hash'] == entry['hash']:
+        entry['encodings'] = previous['encodings']
+        return entry, False
+
+    delete_variants(theme, path, previous['encodings'] if previous else ENCODING_EXTENSIONS)
+
+    if size >= COMPRESS_MIN_SIZE and is_compressible(path):
+        for encoding, data in compress(content).items():
+            replace_file(storage, published_path(theme, path + ENCODING_EXTENSIONS[encoding]), data)
+            entry['encodings'].append(encoding)
+        entry['encodings'].sort()
+    return entry, True
+
+
+def publish_theme(theme, force=False):
+    """
+    Publishes every file in ``theme``, returning the new manifest and the
+    list of paths whose compressed copies were rewritten.
+    """
+    previous = (get_published_manifest(theme) or {}).get('files', {})
+
+    files = {}
+    changed = []
+    for path in walk_storage(default_theme_storage, theme.path):
+        if path.split('/')[0] == PUBLISH_DIR:
+            continue
+        entry, rewritten = publish_file(theme, path, previous.get(path), force=force)
+        files[path] = entry
+        if rewritten:
+            changed.append(path)
+
+    for path in set(previous) - set(files):
+        delete_variants(theme, path, previous[path]['encodings'])
+
+    manifest = {'version': MANIFEST_VERSION, 'files': files}
+    write_published_manifest(theme, manifest)
+    return manifest, changed
+
+
+def update_published_file(theme, path):
+    """
+    Brings the published manifest of ``theme`` up to date after the file at
+    ``path`` was written or deleted. Unpublished themes are left alone.
+    """
+    manifest = get_published_manifest(theme)
+    if manifest is None:
+        return
+    path = posixpath.normpath(path.strip('/'))
+    files = dict(manifest['files'])
+    previous = files.pop(path, None)
+
+    if default_theme_storage.exists(posixpath.join(theme.path, path)):
+        files[path], rewritten = publish_file(theme, path, previous, force=True)
+    elif previous is not None:
+        delete_variants(theme, path, previous['encodings'])
+
+    write_published_manifest(theme, dict(manifest, files=files))
+
+
+def get_published_variant(theme, path, accept_encoding):
+    """
+    Returns ``(storage name, encoding)`` for the best pre-compressed copy of
+    ``path`` the client accepts, or ``None`` if there isn't one.
+    """
+    manifest = get_published_manifest(theme)
+    if manifest is None:
+        return None
+    entry = manifest['files'].get(path)
+    if entry is None:
+        return None
+    accepted = [part.split(';')[0].strip() for part in accept_encoding.split(',')]
+    for encoding in ('br', 'gzip'):
+        if encoding in entry['encodings'] and encoding in accepted:
+            return published_path(theme, path + ENCODING_EXTENSIONS[encoding]), encoding
+    return None
@@ -0,0 +1,363 @@
+"""
+A snapshot of the theme table, shared by every worker through Django's cache.
+
+Loaders read the snapshot instead of querying ``Theme`` for each template.
+Each worker keeps its copy in memory and only fetches a new one once the
+generation counter in the cache has moved on, which happens whenever a theme
+or one of its files changes.
+
+Themes inherit files from their parents. The snapshot holds each theme's
+chain of ancestors already flattened, so resolving a template costs the same
+however deep the chains are.
+
+Themes can also be limited to some hosts. The snapshot maps each host name or
+pattern to the themes used for it, so picking them for a request is a dict
+lookup however many hosts there are.
+"""
+import hashlib
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_themes.middleware import get_current_host, get_current_user_key, get_request_memo
+from django_themes.utils import (
+    THEME_CACHE_KEY_PREFIX, get_previewing_themes, host_patterns, preview_cache_key, wildcard_patterns
+)
+
+GENERATION_CACHE_KEY = THEME_CACHE_KEY_PREFIX + "generation"
+SNAPSHOT_TIMEOUT = getattr(settings, 'THEMES_REGISTRY_TIMEOUT', 60 * 60 * 24)
+# How many generations a worker walks back through to find out which
+# templates changed, before giving up and dropping all of its templates.
+MAX_INVALIDATION_STEPS = 50
+
+ThemeEntry = namedtuple('ThemeEntry', ['pk', 'path', 'order'])
+# ``active`` holds the active themes used for a host, and ``resolved`` the
+# same themes with their ancestors flattened into the order files are
+# resolved in.
+ThemeSet = namedtuple('ThemeSet', ['active', 'resolved'])
+Snapshot = namedtuple('Snapshot', ['generation', 'active', 'themes', 'chains', 'default', 'hosts'])
+
+_snapshot = None
+
+
+def snapshot_cache_key(generation):
+    # Versioned, so snapshots pickled before a change to ``Snapshot`` aren't
+    # read back into it.
+    return "%sregistry-v3-%s" % (THEME_CACHE_KEY_PREFIX, generation)
+
+
+def invalidation_cache_key(generation):
+    return "%sinvalidated-%s" % (THEME_CACHE_KEY_PREFIX, generation)
+
+
+def record_invalidation(generation, previous, templates=(), themes=()):
+    cache.set(
+        invalidation_cache_key(generation),
+        {'previous': previous, 'templates': frozenset(templates), 'themes': frozenset(themes)},
+        SNAPSHOT_TIMEOUT
+    )
+
+
+def get_invalidations(since, generation):
+    """
+    Returns ``(templates, themes)``: the names of the templates that changed
+    between generation ``since`` and ``generation``, and the pks of themes
+    whose templates may all have. Returns ``None`` if that isn't known and
+    every template must be treated as changed.
+    """
+    templates, themes = set(), set()
+    for step in range(MAX_INVALIDATION_STEPS):
+        if generation == since:
+            return templates, themes
+        record = cache.get(invalidation_cache_key(generation))
+        if record is None:
+            return None
+        templates.update(record['templates'])
+        themes.update(record.get('themes', ()))
+        generation = record['previous']
+    return None
+
+
+def initial_generation():
+    # Start from the clock rather than 0, so a counter that was evicted from
+    # the cache never comes back as a generation a worker has already seen.
+    return int(time.time() * 1000)
+
+
+def get_generation():
+    generation = cache.get(GENERATION_CACHE_KEY)
+    if generation is None:
+        cache.add(GENERATION_CACHE_KEY, initial_generation(), None)
+        generation = cache.get(GENERATION_CACHE_KEY)
+    return generation
+
+
+def bump_generation(invalidated_templates=None, invalidated_themes=None):
+    """
+    Marks every worker's snapshot, and everything cached against it, as stale.
+
+    If only the templates named in ``invalidated_templates``, or the files of
+    the themes in ``invalidated_themes``, changed, that is recorded against
+    the new generation, so workers only drop those from their template
+    caches rather than everything.
+    """
+    try:
+        generation = cache.incr(GENERATION_CACHE_KEY)
+    except ValueError:
+        generation = initial_generation()
+        cache.set(GENERATION_CACHE_KEY, generation, None)
+        return generation
+    if invalidated_templates is not None or invalidated_themes is not None:
+        record_invalidation(generation, generation - 1, invalidated_templates or (), invalidated_themes or ())
+    return generation
+
+
+def next_generation():
+    """
+    Returns a generation number no worker has seen yet, without making it the
+    current one.
+    """
+    return max(initial_generation(), get_generation() + 1)
+
+
+def publish_snapshot(snapshot, invalidated_templates=()):
+    """
+    Makes ``snapshot`` the current one for every worker in one step, by
+    storing it and then switching the generation counter to its generation.
+    By default no template files are treated as changed.
+    """
+    if invalidated_templates is not None:
+        record_invalidation(snapshot.generation, get_generation(), invalidated_templates)
+    cache.set(snapshot_cache_key(snapshot.generation), snapshot, SNAPSHOT_TIMEOUT)
+    cache.set(GENERATION_CACHE_KEY, snapshot.generation, None)
+
+
+def build_snapshot(generation):
+    from django_themes.metrics import increment, timer
+    from django_themes.models import Theme
+
+    with timer('theme-registry'):
+        rows = list(
+            Theme.objects.all().order_by('-order', 'pk').values_list(
+                'pk', 'path', 'order', 'is_active', 'parent', 'hosts'
+            )
+        )
+    increment('registry.queries')
+
+    themes = dict((pk, ThemeEntry(pk=pk, path=path, order=order)) for pk, path, order, _, _, _ in rows)
+    parents = dict((pk, parent) for pk, _, _, _, parent, _ in rows)
+    chains = {}
+    for pk in themes:
+        chain, seen = [], set()
+        # ``Theme.clean`` rejects cycles, but stop at one anyway rather than
+        # loop forever on a table edited some other way.
+        while pk in themes and pk not in seen:
+            seen.add(pk)
+            chain.append(themes[pk])
+            pk = parents[pk]
+        chains[chain[0].pk] = tuple(chain)
+
+    active = [themes[pk] for pk, _, _, is_active, _, _ in rows if is_active]
+    hosts = dict((pk, host_patterns(hosts)) for pk, _, _, is_active, _, hosts in rows if is_active)
+    default, host_sets = build_theme_sets(active, hosts, chains)
+    return Snapshot(
+        generation=generation,
+        active=tuple(active),
+        themes=themes,
+        chains=chains,
+        default=default,
+        hosts=host_sets,
+    )
+
+
+def build_theme_sets(active, hosts, chains):
+    """
+    Returns ``(default, host_sets)``: the ``ThemeSet`` of the ``active``
+    themes used for every host, and one for each host name or pattern in
+    ``hosts``, which maps theme pks to their host patterns.
+    """
+    # Active themes with no hosts are used everywhere, the rest only for the
+    # hosts they list.
+    shared, by_pattern = [], {}
+    for theme in active:
+        patterns = hosts.get(theme.pk)
+        if not patterns:
+            shared.append(theme)
+        for pattern in patterns or ():
+            by_pattern.setdefault(pattern, set()).add(theme)
+
+    def theme_set(entries):
+        entries = tuple(sorted(entries, key=lambda theme: (-theme.order, theme.pk)))
+        return ThemeSet(active=entries, resolved=flatten_chains(entries, chains))
+
+    # A host gets the themes of every pattern matching it, so each pattern's
+    # set includes those of the wildcards that match it too.
+    host_sets = {}
+    for pattern, entries in by_pattern.items():
+        entries = set(entries).union(shared)
+        for wildcard in wildcard_patterns(pattern[2:] if pattern.startswith('*.') else pattern):
+            entries.update(by_pattern.get(wildcard, ()))
+        host_sets[pattern] = theme_set(entries)
+    return theme_set(shared), host_sets
+
+
+def flatten_chains(themes, chains):
+    """
+    Returns ``themes``, in order, each followed by its ancestors from
+    ``chains``. A theme that appears more than once is kept where it is
+    first found.
+    """
+    resolved, seen = [], set()
+    for theme in themes:
+        for entry in chains.get(theme.pk, (theme,)):
+            if entry.pk not in seen:
+                seen.add(entry.pk)
+                resolved.append(entry)
+    return tuple(resolved)
+
+
+def get_snapshot(generation=None):
+    """
+    Returns the current ``Snapshot``, holding the active themes as an ordered
+    tuple of ``ThemeEntry``, every theme and its chain of ancestors by
+    primary key, and the ``ThemeSet`` used for hosts no theme lists along
+    with one for each host name or pattern that is. ``generation`` can be
+    passed if it was already read from the cache.
+    """
+    global _snapshot
+    if generation is None:
+        generation = get_generation()
+    snapshot = _snapshot
+    if snapshot is not None and generation is not None and snapshot.generation == generation:
+        return snapshot
+
+    snapshot = cache.get(snapshot_cache_key(generation))
+    if snapshot is None:
+        snapshot = build_snapshot(generation)
+        cache.set(snapshot_cache_key(generation), snapshot, SNAPSHOT_TIMEOUT)
+    _snapshot = snapshot
+    return snapshot
+
+
+def get_theme_set(snapshot, host=None):
+    """
+    Returns the ``ThemeSet`` used for ``host``: the one for the host name
+    itself, or else for the most specific wildcard matching it, or else the
+    themes used for every host.
+    """
+    if not host or not snapshot.hosts:
+        return snapshot.default
+    host = host.lower().rstrip('.')
+    theme_set = snapshot.hosts.get(host)
+    if theme_set is not None:
+        return theme_set
+    for pattern in wildcard_patterns(host):
+        theme_set = snapshot.hosts.get(pattern)
+        if theme_set is not None:
+            return theme_set
+    return snapshot.default
+
+
+def get_themes(preview_pks=None, snapshot=None, host=None):
+    """
+    Returns the ordered tuple of ``ThemeEntry`` used to resolve files: the
+    active themes for ``host`` plus any themes in ``preview_pks``, each
+    followed by its ancestors.
+    """
+    if snapshot is None:
+        snapshot = get_snapshot()
+    theme_set = get_theme_set(snapshot, host)
+    if not preview_pks:
+        return theme_set.resolved
+    themes = set(theme_set.active)
+    themes.update(snapshot.themes[pk] for pk in preview_pks if pk in snapshot.themes)
+    return flatten_chains(sorted(themes, key=lambda theme: (-theme.order, theme.pk)), snapshot.chains)
+
+
+def load_request_state(memo):
+    """
+    Fills ``memo`` with the ``Snapshot`` and preview pks for the current
+    request, reading the generation and the user's preview set from the cache
+    in one lookup.
+    """
+    user_key = get_current_user_key()
+    keys = [GENERATION_CACHE_KEY]
+    if user_key is not None:
+        keys.append(preview_cache_key(user_key))
+    found = cache.get_many(keys)
+    preview_pks = []
+    if user_key is not None:
+        preview_pks = list(found.get(preview_cache_key(user_key)) or [])
+    memo['snapshot'] = get_snapshot(found.get(GENERATION_CACHE_KEY))
+    memo['preview_pks'] = preview_pks
+
+
+def get_current_snapshot():
+    """
+    Returns the ``Snapshot`` for the current request. It is fetched once per
+    request, so every template in a render is resolved against the same one.
+    """
+    memo = get_request_memo()
+    if memo is None:
+        return get_snapshot()
+    if 'snapshot' not in memo:
+        load_request_state(memo)
+    return memo['snapshot']
+
+
+def get_current_preview_pks():
+    """
+    Returns the primary keys of the themes the current user is previewing,
+    looked up once per request.
+    """
+    memo = get_request_memo()
+    if memo is None:
+        user_key = get_current_user_key()
+        if user_key is None:
+            return []
+        return get_previewing_themes(user_key)
+    if 'preview_pks' not in memo:
+        load_request_state(memo)
+    return memo['preview_pks']
+
+
+def get_current_themes(snapshot=None):
+    """
+    Returns the themes used to resolve files for the current request: the
+    active themes for its host, plus any the current user is previewing.
+    Within a request they are only worked out once for each snapshot.
+    """
+    if snapshot is None:
+        snapshot = get_current_snapshot()
+    memo = get_request_memo()
+    if memo is not None:
+        themes = memo.get('themes')
+        if themes is not None and themes[0] is snapshot:
+            return themes[1]
+    themes = get_themes(get_current_preview_pks(), snapshot=snapshot, host=get_current_host())
+    if memo is not None:
+        memo['themes'] = (snapshot, themes)
+    return themes
+
+
+def theme_set_fingerprint(themes, generation):
+    """
+    Returns a short string that is the same for every request resolving
+    files against ``themes`` in the same generation, and changes whenever a
+    theme or theme file does.
+    """
+    key = "%s:%s" % (generation, ",".join(str(theme.pk) for theme in themes))
+    return hashlib.md5(key.encode('ascii')).hexdigest()[:16]
+
+
+def get_current_fingerprint():
+    """
+    Returns ``(fingerprint, previewing)`` for the current request, where
+    ``previewing`` is whether the user sees themes other than the active ones.
+    """
+    snapshot = get_current_snapshot()
+    themes = get_current_themes(snapshot)
+    previewing = themes != get_theme_set(snapshot, get_current_host()).resolved
+    return theme_set_fingerprint(themes, snapshot.generation), previewing
@@ -0,0 +1,150 @@
+"""
+Streaming responses for files in theme storage.
+"""
+import calendar
+import mimetypes
+import re
+import time
+
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+from django_themes.storage import get_modified_time
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    """
+    Returns the inclusive ``(start, end)`` byte positions asked for by a
+    single range ``Range`` header, ``None`` if the header should be ignored,
+    or ``False`` if the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # A suffix range, the last ``end`` bytes of the file.
+        length = int(end)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def iter_range(fh, start, length, chunk_size=CHUNK_SIZE):
+    try:
+        fh.seek(start)
+        while length > 0:
+            data = fh.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fh.close()
+
+
+def timestamp(dt):
+    if dt.tzinfo is None:
+        return int(time.mktime(dt.timetuple()))
+    return int(calendar.timegm(dt.utctimetuple()))
+
+
+def file_etag(size, modified):
+    """
+    Returns a weak ETag built from the size and modified time of a file, so
+    it can be computed without reading the file.
+    """
+    return 'W/"%x-%x"' % (size, timestamp(modified))
+
+
+def strip_weak(etag):
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    return strip_weak(etag) in [strip_weak(tag) for tag in header.split(',')]
+
+
+def is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified is not None and last_modified <= if_modified_since
+
+
+def if_range_matches(if_range, etag, last_modified):
+    """
+    Whether an ``If-Range`` header still matches the file. Entity tags are
+    compared strongly, so a weak one never matches (RFC 7233, section 3.2).
+    """
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag and not etag.startswith('W/')
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def file_response(request, storage, name, content_type=None, as_attachment=False, etag=None):
+    """
+    Streams the file at ``name`` from ``storage``.
+
+    The ``ETag`` and ``Last-Modified`` headers come from the storage's size
+    and modified time for the file, unless an ``etag`` is given, and matching
+    ``If-None-Match`` or ``If-Modified-Since`` headers get a ``304`` without
+    opening the file. A ``Range`` header asking for a single range of bytes
+    is honoured, as long as any ``If-Range`` header still matches.
+    """
+    if content_type is None:
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    size = storage.size(name)
+    modified = get_modified_time(storage, name)
+    last_modified = timestamp(modified)
+    if etag is None:
+        etag = file_etag(size, modified)
+
+    if request.method in ('GET', 'HEAD') and is_not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    byte_range = parse_range(request.META.get('HTTP_RANGE', ''), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range and if_range and not if_range_matches(if_range, etag, last_modified):
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+    elif byte_range is None:
+        response = FileResponse(storage.open(name), content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            iter_range(storage.open(name), start, end - start + 1),
+            status=206, content_type=content_type
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if as_attachment:
+        filename = name.rsplit('/', 1)[-1].replace('"', '')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent whenever a file inside a theme is written or deleted through Django
+# themes, with the ``theme`` it belongs to and its ``path`` within the theme.
+theme_file_changed = Signal()
@@ -0,0 +1,138 @@
+/*
+ * Chunked, resumable uploads for DropzoneJS versions without chunking (before 5.2).
+ *
+ * Takes the same options as Dropzone 5.2: with ``chunking`` on, files bigger than
+ * ``chunkSize`` bytes are sent a chunk at a time, posted with the ``dzuuid``,
+ * ``dzchunkindex``, ``dztotalfilesize``, ``dzchunksize``, ``dztotalchunkcount`` and
+ * ``dzchunkbyteoffset`` parameters, and ``chunksUploaded(file, done)`` is called once
+ * they have all arrived. Chunks are sent one after another, each retried up to
+ * ``retryChunksLimit`` times if ``retryChunks`` is on. Before sending, the server is
+ * asked which chunks of the upload it already has, so sending a file again resumes it.
+ *
+ * Nothing is changed for versions of Dropzone that chunk uploads themselves.
+ */
+(function() {
+  if (typeof Dropzone === "undefined" || "chunking" in Dropzone.prototype.defaultOptions) {
+    return;
+  }
+
+  var uploadFiles = Dropzone.prototype.uploadFiles;
+
+  function makeUuid() {
+    return "xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx".replace(/[xy]/g, function(c) {
+      var r = Math.random() * 16 | 0;
+      return (c === "x" ? r : (r & 0x3 | 0x8)).toString(16);
+    });
+  }
+
+  function withParam(url, name, value) {
+    return url + (url.indexOf("?") === -1 ? "?" : "&") + name + "=" + encodeURIComponent(value);
+  }
+
+  function errorMessage(dropzone, xhr) {
+    try {
+      return JSON.parse(xhr.responseText).error;
+    } catch (e) {
+      return dropzone.options.dictResponseError.replace("{{statusCode}}", xhr.status);
+    }
+  }
+
+  function uploadChunked(dropzone, file) {
+    var options = dropzone.options;
+    var url = typeof options.url === "function" ? options.url.call(dropzone, [file]) : options.url;
+    var chunkSize = options.chunkSize;
+    var totalChunks = Math.ceil(file.size / chunkSize);
+    var retries = options.retryChunks ? (options.retryChunksLimit || 3) : 0;
+    var csrf = dropzone.element.querySelector("[name=csrfmiddlewaretoken]");
+    var received = {};
+
+    file.upload.uuid = file.upload.uuid || makeUuid();
+    file.upload.totalChunkCount = totalChunks;
+
+    function request(method, requestUrl, data, onload) {
+      var xhr = new XMLHttpRequest();
+      file.xhr = xhr;
+      xhr.open(method, requestUrl, true);
+      xhr.timeout = options.timeout;
+      xhr.setRequestHeader("Accept", "application/json");
+      xhr.setRequestHeader("X-Requested-With", "XMLHttpRequest");
+      if (csrf) {
+        xhr.setRequestHeader("X-CSRFToken", csrf.value);
+      }
+      xhr.onload = function() {
+        if (file.status !== Dropzone.CANCELED) {
+          onload(xhr);
+        }
+      };
+      xhr.onerror = xhr.ontimeout = function() {
+        if (file.status !== Dropzone.CANCELED) {
+          onload(xhr);
+        }
+      };
+      xhr.send(data);
+    }
+
+    function progress(index) {
+      var sent = Math.min(file.size, index * chunkSize);
+      file.upload.bytesSent = sent;
+      file.upload.progress = file.size ? 100 * sent / file.size : 100;
+      dropzone.emit("uploadprogress", file, file.upload.progress, sent);
+    }
+
+    function finish() {
+      progress(totalChunks);
+      options.chunksUploaded.call(dropzone, file, function() {
+        dropzone._finished([file], "", null);
+      });
+    }
+
+    function send(index, attempt) {
+      while (index < totalChunks && received[index]) {
+        index++;
+      }
+      progress(index);
+      if (index >= totalChunks) {
+        return finish();
+      }
+      var start = index * chunkSize;
+      var data = new FormData();
+      data.append("dzuuid", file.upload.uuid);
+      data.append("dzchunkindex", index);
+      data.append("dztotalfilesize", file.size);
+      data.append("dzchunksize", chunkSize);
+      data.append("dztotalchunkcount", totalChunks);
+      data.append("dzchunkbyteoffset", start);
+      data.append(dropzone._getParamName(0), file.slice(start, Math.min(file.size, start + chunkSize)), file.upload.filename);
+      request("POST", url, data, function(xhr) {
+        if (xhr.status >= 200 && xhr.status < 300) {
+          received[index] = true;
+          send(index + 1, 0);
+        } else if (attempt < retries && xhr.status !== 400) {
+          send(index, attempt + 1);
+        } else {
+          dropzone._errorProcessing([file], errorMessage(dropzone, xhr), xhr);
+        }
+      });
+    }
+
+    request("GET", withParam(url, "dzuuid", file.upload.uuid), null, function(xhr) {
+      if (xhr.status === 200) {
+        try {
+          JSON.parse(xhr.responseText).chunks.forEach(function(index) {
+            received[index] = true;
+          });
+        } catch (e) {}
+      }
+      send(0, 0);
+    });
+  }
+
+  Dropzone.prototype.uploadFiles = function(files) {
+    var options = this.options;
+    if (options.chunking && options.chunkSize && !options.uploadMultiple && files.length === 1 &&
+        files[0].size > options.chunkSize) {
+      return uploadChunked(this, files[0]);
+    }
+    return uploadFiles.call(this, files);
+  };
+})();
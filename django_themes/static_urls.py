@@ -0,0 +1,8 @@
+from django.conf.urls import url
+
+from django_themes.staticfiles import serve, serve_file
+
+urlpatterns = [
+    url(r'^(?P<theme_id>\d+)/(?P<digest>[0-9a-f]+)/(?P<path>.+)$', serve, name='django_themes_static'),
+    url(r'^files/(?P<name>.+)$', serve_file, name='django_themes_file'),
+]
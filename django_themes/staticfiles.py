@@ -0,0 +1,127 @@
+"""
+Serving static files from themes, with URLs that change whenever a file does.
+
+``theme_static_url`` resolves a path against the current themes in order and
+returns a URL containing the digest of the matching file, so the response can
+be cached indefinitely by browsers and CDNs.
+"""
+import mimetypes
+import posixpath
+
+from django.conf import settings
+from django.http import Http404
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+from django_themes import registry
+from django_themes.manifest import get_static_manifests
+from django_themes.publish import get_published_manifest, get_published_variant
+from django_themes.responses import file_response
+from django_themes.storage import default_theme_storage
+
+STATIC_MAX_AGE = getattr(settings, 'THEMES_STATIC_MAX_AGE', 60 * 60 * 24 * 365)
+
+
+def get_theme_static_path(theme, path):
+    return posixpath.join(theme.path, 'static', path)
+
+
+def find_static(path, themes=None):
+    """
+    Returns ``(theme, digest)`` for the highest ranked of ``themes`` holding
+    the static file at ``path``, or ``(None, None)`` if none of them do.
+    """
+    if themes is None:
+        themes = registry.get_current_themes()
+    manifests = get_static_manifests(themes)
+    for theme in themes:
+        digest = manifests[theme.pk].get(path)
+        if digest is not None:
+            return theme, digest
+    return None, None
+
+
+def theme_static_url(path):
+    """
+    Returns the URL for the static file at ``path`` in the current themes,
+    falling back to Django's ``static`` if no theme provides it.
+    """
+    theme, digest = find_static(path)
+    if theme is None:
+        return static(path)
+    return reverse(
+        'django_themes_static',
+        kwargs={'theme_id': theme.pk, 'digest': digest, 'path': path}
+    )
+
+
+def serve(request, theme_id, digest, path):
+    """
+    Serves a static file from a theme, with support for conditional and range
+    requests. Responses for the current digest of a file are marked as
+    cacheable forever, anything else must be revalidated.
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith('..'):
+        raise Http404
+
+    themes = registry.get_current_themes()
+    theme = dict((theme.pk, theme) for theme in themes).get(int(theme_id))
+    if theme is None:
+        raise Http404
+
+    current_digest = get_static_manifests([theme])[theme.pk].get(path)
+    if current_digest is None:
+        raise Http404
+
+    content_type, encoding = mimetypes.guess_type(path)
+    name = get_theme_static_path(theme, path)
+    etag = None
+    published = get_published_manifest(theme)
+    if published is not None:
+        entry = published['files'].get(posixpath.join('static', path))
+        variant = get_published_variant(
+            theme, posixpath.join('static', path), request.META.get('HTTP_ACCEPT_ENCODING', '')
+        )
+        if variant is not None:
+            name, encoding = variant
+        if entry is not None:
+            etag = '"%s%s"' % (entry['hash'], '-' + encoding if encoding else '')
+
+    response = file_response(
+        request, default_theme_storage, name,
+        content_type=content_type or 'application/octet-stream', etag=etag
+    )
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if published is not None:
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+    if digest == current_digest:
+        patch_cache_control(response, public=True, max_age=STATIC_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
+
+
+def serve_file(request, name):
+    """
+    Serves the file at ``name`` in theme storage, for storages that have no
+    URLs of their own such as ``DatabaseStorage``. Only files in the
+    ``static`` folder of a theme are served, and the URL doesn't change with
+    the file, so responses must be revalidated.
+    """
+    name = posixpath.normpath(name).lstrip('/')
+    if name.startswith('..'):
+        raise Http404
+    snapshot = registry.get_snapshot()
+    if not any(name.startswith(get_theme_static_path(theme, '')) for theme in snapshot.themes.values()):
+        raise Http404
+
+    try:
+        response = file_response(request, default_theme_storage, name)
+    except (IOError, OSError):
+        raise Http404
+    patch_cache_control(response, no_cache=True)
+    return response
@@ -1,15 +1,323 @@
+import hashlib
+import os
+import posixpath
+import time
+from collections import namedtuple
+from datetime import datetime
+
 from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils import timezone
 from django.utils.functional import LazyObject
 from django.utils.module_loading import import_string
 
+from django_themes.utils import THEME_CACHE_KEY_PREFIX, LRUCache
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+FileStat = namedtuple('FileStat', ['name', 'size', 'modified'])
+FileContents = namedtuple('FileContents', ['contents', 'lines', 'size', 'truncated', 'binary'])
+
 
 def get_storage_class(import_path=None):
     return import_string(import_path or settings.THEMES_FILE_STORAGE)
 
 
+def get_modified_time(storage, name):
+    """
+    Returns the last modified time of ``name``, using ``get_modified_time``
+    where the storage has it and ``modified_time`` on older Django versions.
+    """
+    if hasattr(storage, 'get_modified_time'):
+        return storage.get_modified_time(name)
+    return storage.modified_time(name)
+
+
+def datetime_from_timestamp(ts):
+    if settings.USE_TZ:
+        return datetime.utcfromtimestamp(ts).replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(ts)
+
+
+def listdir_with_stats_local(storage, path):
+    root = storage.path(path)
+    folders, files = [], []
+    if scandir is not None:
+        for entry in scandir(root):
+            if entry.is_dir():
+                folders.append(entry.name)
+            else:
+                stat = entry.stat()
+                files.append(FileStat(entry.name, stat.st_size, datetime_from_timestamp(stat.st_mtime)))
+    else:
+        for name in os.listdir(root):
+            full_path = os.path.join(root, name)
+            if os.path.isdir(full_path):
+                folders.append(name)
+            else:
+                stat = os.stat(full_path)
+                files.append(FileStat(name, stat.st_size, datetime_from_timestamp(stat.st_mtime)))
+    return folders, files
+
+
+def listdir_with_stats_s3(storage, path):
+    prefix = storage._normalize_name(path.strip('/'))
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    folders, files = [], []
+    paginator = storage.bucket.meta.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=storage.bucket.name, Delimiter='/', Prefix=prefix):
+        for common_prefix in page.get('CommonPrefixes', []):
+            folders.append(common_prefix['Prefix'][len(prefix):].rstrip('/'))
+        for obj in page.get('Contents', []):
+            name = obj['Key'][len(prefix):]
+            if not name:
+                continue
+            modified = obj['LastModified']
+            if not settings.USE_TZ:
+                modified = timezone.make_naive(modified)
+            files.append(FileStat(name, obj['Size'], modified))
+    return folders, files
+
+
+def listdir_with_stats(storage, path):
+    """
+    Returns ``(folders, files)`` for ``path``, where ``files`` is a list of
+    ``FileStat`` with the name, size and modified time of each file.
+
+    Storages can provide their own ``listdir_with_stats`` method. Otherwise
+    local storage is read with a single ``scandir`` and S3 with paginated
+    ``ListObjectsV2`` calls, while anything else falls back to asking for
+    the size and modified time of each file.
+    """
+    if hasattr(storage, 'listdir_with_stats'):
+        return storage.listdir_with_stats(path)
+    if isinstance(storage, FileSystemStorage):
+        return listdir_with_stats_local(storage, path)
+    if hasattr(getattr(storage, 'bucket', None), 'meta'):
+        return listdir_with_stats_s3(storage, path)
+
+    folders, names = storage.listdir(path)
+    files = []
+    for name in names:
+        full_path = posixpath.join(path, name)
+        files.append(FileStat(name, storage.size(full_path), get_modified_time(storage, full_path)))
+    return folders, files
+
+
+def walk_storage(storage, path):
+    """
+    Yields the path, relative to ``path``, of every file below ``path``.
+    """
+    try:
+        folders, files = storage.listdir(path)
+    except (IOError, OSError):
+        return
+    for name in files:
+        yield name
+    for folder in folders:
+        for name in walk_storage(storage, posixpath.join(path, folder)):
+            yield posixpath.join(folder, name)
+
+
+def read_text(storage, name, limit=None, charset='utf-8'):
+    """
+    Reads at most ``limit`` bytes of ``name`` for display, returning a
+    ``FileContents`` with the decoded text, the number of lines read, the full
+    size of the file and whether it was truncated or looks like binary data.
+    """
+    with storage.open(name) as fh:
+        size = fh.size
+        data = fh.read() if limit is None else fh.read(limit)
+    if not isinstance(data, bytes):
+        data = data.encode(charset)
+
+    binary = b'\0' in data[:8192]
+    lines = data.count(b'\n')
+    if data and not data.endswith(b'\n'):
+        lines += 1
+    return FileContents(
+        contents='' if binary else data.decode(charset, 'replace'),
+        lines=lines,
+        size=size,
+        truncated=len(data) < size,
+        binary=binary,
+    )
+
+
+def replace_file(storage, name, content):
+    """
+    Saves ``content`` at exactly ``name``, replacing any existing file rather
+    than letting the storage pick an alternative name. Storages with their own
+    ``replace`` method do this in one step.
+    """
+    if not hasattr(content, 'chunks'):
+        content = ContentFile(content)
+    if hasattr(storage, 'replace'):
+        return storage.replace(name, content)
+    if storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, content)
+
+
+def storage_cache_name(name):
+    name = posixpath.normpath((name or '').replace('\\', '/').strip('/'))
+    return '' if name == '.' else name
+
+
+class CachedStorage(Storage):
+    """
+    Wraps ``storage`` with two tiers of read-through caching: a bounded
+    in-process LRU, in front of a Django cache shared by every process.
+
+    ``exists``, ``listdir``, ``listdir_with_stats``, ``size`` and modified
+    times are cached, as are the contents of files no bigger than
+    ``max_size`` bytes; bigger files are always read from ``storage``.
+    Writes and deletes made through the wrapper drop what they affect from
+    both tiers, but only in the process that made them. Other processes
+    call ``clear_local`` when the registry generation moves on, which
+    django-themes does for every change it makes. Anything changed behind
+    its back is seen once entries time out: after ``local_timeout`` seconds
+    in the process, ``timeout`` in the shared cache.
+    """
+    missing = object()
+
+    def __init__(self, storage, cache_alias='default', timeout=60, local_timeout=5,
+                 local_size=1000, max_size=64 * 1024):
+        self.storage = storage
+        self.cache = caches[cache_alias]
+        self.timeout = timeout
+        self.local_timeout = local_timeout
+        self.local = LRUCache(local_size)
+        self.max_size = max_size
+
+    def __getattr__(self, name):
+        # Anything not cached, such as ``location`` or ``bucket``, comes
+        # straight from the wrapped storage.
+        if name == 'storage':
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def cache_key(self, kind, name):
+        digest = hashlib.md5(storage_cache_name(name).encode('utf-8')).hexdigest()
+        return "%sstorage-%s-%s" % (THEME_CACHE_KEY_PREFIX, kind, digest)
+
+    def cached(self, kind, name, compute):
+        key = self.cache_key(kind, name)
+        now = time.time()
+        entry = self.local.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = self.cache.get(key, self.missing)
+        if value is self.missing:
+            value = compute()
+            self.cache.set(key, value, self.timeout)
+        self.local.set(key, (now + self.local_timeout, value))
+        return value
+
+    def invalidate(self, name):
+        """
+        Drops everything cached about the file ``name``, and the listings
+        and existence of the folders holding it.
+        """
+        name = storage_cache_name(name)
+        keys = [self.cache_key(kind, name) for kind in ('exists', 'size', 'modified', 'contents')]
+        folder = name
+        while folder:
+            folder = posixpath.dirname(folder)
+            keys.extend(self.cache_key(kind, folder) for kind in ('exists', 'listdir', 'listdir_stats'))
+        for key in keys:
+            self.local.delete(key)
+        self.cache.delete_many(keys)
+
+    def clear_local(self):
+        """
+        Drops everything held in this process, so the next reads go to the
+        shared cache.
+        """
+        self.local.clear()
+
+    def read_small_file(self, name):
+        if self.size(name) > self.max_size:
+            return None
+        with self.storage.open(name) as fh:
+            data = fh.read()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    def _open(self, name, mode='rb'):
+        if any(flag in mode for flag in 'wa+'):
+            self.invalidate(name)
+            return self.storage.open(name, mode)
+        data = self.cached('contents', name, lambda: self.read_small_file(name))
+        if data is None:
+            return self.storage.open(name, mode)
+        return ContentFile(data, name=name)
+
+    def _save(self, name, content):
+        name = self.storage.save(name, content)
+        self.invalidate(name)
+        return name
+
+    def replace(self, name, content):
+        name = replace_file(self.storage, name, content)
+        self.invalidate(name)
+        return name
+
+    def delete(self, name):
+        self.storage.delete(name)
+        self.invalidate(name)
+
+    def exists(self, name):
+        return self.cached('exists', name, lambda: self.storage.exists(name))
+
+    def listdir(self, path):
+        return self.cached('listdir', path, lambda: self.storage.listdir(path))
+
+    def listdir_with_stats(self, path):
+        return self.cached('listdir_stats', path, lambda: listdir_with_stats(self.storage, path))
+
+    def size(self, name):
+        return self.cached('size', name, lambda: self.storage.size(name))
+
+    def get_modified_time(self, name):
+        return self.cached('modified', name, lambda: get_modified_time(self.storage, name))
+
+    modified_time = get_modified_time
+
+    def url(self, name):
+        return self.storage.url(name)
+
+    def path(self, name):
+        return self.storage.path(name)
+
+
+def get_storage_cache_options():
+    """
+    Returns the keyword arguments for ``CachedStorage`` from the
+    ``THEMES_FILE_STORAGE_CACHE`` setting, or ``None`` if it is off.
+    """
+    options = getattr(settings, 'THEMES_FILE_STORAGE_CACHE', None)
+    if not options:
+        return None
+    if options is True:
+        return {}
+    return dict(options)
+
+
 class DefaultStorage(LazyObject):
     def _setup(self):
-        self._wrapped = get_storage_class()(location=settings.THEMES_FILE_ROOT)
+        storage = get_storage_class()(location=settings.THEMES_FILE_ROOT)
+        options = get_storage_cache_options()
+        if options is not None:
+            storage = CachedStorage(storage, **options)
+        self._wrapped = storage
 
 
 default_theme_storage = DefaultStorage()
@@ -0,0 +1,68 @@
+from django import template
+from django.core.cache.utils import make_template_fragment_key
+from django.templatetags.cache import CacheNode
+
+from django_themes.registry import get_current_fingerprint
+from django_themes.staticfiles import theme_static_url
+
+register = template.Library()
+
+
+@register.simple_tag
+def theme_static(path):
+    """
+    Returns the URL of the static file at ``path`` from the highest ranked
+    current theme that has it, or from Django's staticfiles if none do::
+
+        {% load themes %}
+        <link rel="stylesheet" href="{% theme_static "css/site.css" %}">
+    """
+    return theme_static_url(path)
+
+
+class ThemeSetFingerprint(object):
+    """
+    Stands in for a template variable in ``CacheNode.vary_on``, resolving to
+    the fingerprint of the themes used for the current request.
+    """
+
+    def resolve(self, context):
+        return get_current_fingerprint()[0]
+
+
+def theme_fragment_key(fragment_name, vary_on=None):
+    """
+    Returns the cache key ``{% themecache %}`` uses for ``fragment_name`` and
+    ``vary_on`` with the current request's themes, for deleting a fragment.
+    """
+    return make_template_fragment_key(fragment_name, [get_current_fingerprint()[0]] + list(vary_on or []))
+
+
+@register.tag('themecache')
+def do_themecache(parser, token):
+    """
+    Works like Django's ``{% cache %}`` tag, but keeps a separate copy of the
+    fragment for each set of themes, so it is rendered again after themes or
+    theme files change, and users previewing themes get their own::
+
+        {% load themes %}
+        {% themecache 500 sidebar request.user.pk using="fragments" %}
+            .. some expensive processing ..
+        {% endthemecache %}
+    """
+    nodelist = parser.parse(('endthemecache',))
+    parser.delete_first_token()
+    tokens = token.split_contents()
+    if len(tokens) < 3:
+        raise template.TemplateSyntaxError("'%r' tag requires at least 2 arguments." % tokens[0])
+    if len(tokens) > 3 and tokens[-1].startswith('using='):
+        cache_name = parser.compile_filter(tokens[-1][len('using='):])
+        tokens = tokens[:-1]
+    else:
+        cache_name = None
+    return CacheNode(
+        nodelist, parser.compile_filter(tokens[1]),
+        tokens[2],  # fragment_name can't be a variable.
+        [ThemeSetFingerprint()] + [parser.compile_filter(t) for t in tokens[3:]],
+        cache_name,
+    )
@@ -0,0 +1,203 @@
+import io
+import shutil
+import tempfile
+import zipfile
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils.functional import empty
+
+from django_themes.activation import ActivationError, activate_themes
+from django_themes.archive import export_theme
+from django_themes.manifest import get_template_manifests, manifest_cache_key, update_template_manifest
+from django_themes.models import Theme
+from django_themes.responses import file_response
+from django_themes.storage import default_theme_storage
+
+
+class ThemeStorageTestCase(TestCase):
+
+    """
+    Keeps theme files in a temporary folder for the length of each test.
+    """
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(THEMES_FILE_ROOT=root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        default_theme_storage._wrapped = empty
+        self.addCleanup(setattr, default_theme_storage, '_wrapped', empty)
+        cache.clear()
+
+        self.theme = Theme.objects.create(name="Test", author="Test", path="test")
+
+
+class ManifestTests(ThemeStorageTestCase):
+
+    def test_update_adds_and_removes_templates(self):
+        self.assertEqual(get_template_manifests([self.theme])[self.theme.pk], frozenset())
+
+        default_theme_storage.save('test/templates/page.html', ContentFile(b'page'))
+        update_template_manifest(self.theme, 'templates/page.html')
+        self.assertEqual(get_template_manifests([self.theme])[self.theme.pk], frozenset(['page.html']))
+
+        default_theme_storage.delete('test/templates/page.html')
+        update_template_manifest(self.theme, 'templates/page.html')
+        self.assertEqual(get_template_manifests([self.theme])[self.theme.pk], frozenset())
+
+    def test_update_while_locked_drops_manifest(self):
+        get_template_manifests([self.theme])
+        key = manifest_cache_key(self.theme)
+        cache.set(key + '-lock', 1)
+
+        default_theme_storage.save('test/templates/page.html', ContentFile(b'page'))
+        update_template_manifest(self.theme, 'templates/page.html')
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(get_template_manifests([self.theme])[self.theme.pk], frozenset(['page.html']))
+
+    def test_activation_checks_files_written_outside_the_admin(self):
+        get_template_manifests([self.theme])
+        default_theme_storage.save('test/templates/broken.html', ContentFile(b'{% if %}'))
+
+        with self.assertRaises(ActivationError) as raised:
+            activate_themes([self.theme])
+        self.assertEqual([name for name, error in raised.exception.args[0]], ['broken.html'])
+
+
+class FileResponseTests(ThemeStorageTestCase):
+
+    def setUp(self):
+        super(FileResponseTests, self).setUp()
+        default_theme_storage.save('test/static/file.txt', ContentFile(b'0123456789'))
+
+    def get(self, etag=None, **headers):
+        request = RequestFactory().get('/file.txt', **headers)
+        return file_response(request, default_theme_storage, 'test/static/file.txt', etag=etag)
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+
+    def test_if_range_with_strong_etag(self):
+        response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"abc"', etag='"abc"')
+        self.assertEqual(response.status_code, 206)
+
+        response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"def"', etag='"abc"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_range_with_weak_etag_sends_whole_file(self):
+        etag = self.get()['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_if_range_with_date(self):
+        last_modified = self.get()['Last-Modified']
+        response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE=last_modified)
+        self.assertEqual(response.status_code, 206)
+
+
+class AdminTestCase(ThemeStorageTestCase):
+
+    def setUp(self):
+        super(AdminTestCase, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+
+    def editor_url(self, path=''):
+        return reverse('admin:django_themes_theme_theme_editor', args=[self.theme.pk, path])
+
+
+class HiddenFolderTests(AdminTestCase):
+
+    def setUp(self):
+        super(HiddenFolderTests, self).setUp()
+        default_theme_storage.save('test/templates/page.html', ContentFile(b'page'))
+        default_theme_storage.save('test/.published/manifest.json', ContentFile(b'{}'))
+        default_theme_storage.save('test/.uploads/abc/000000', ContentFile(b'chunk'))
+
+    def test_browser_hides_folders(self):
+        response = self.client.get(self.editor_url())
+        self.assertContains(response, 'templates')
+        self.assertNotContains(response, '.published')
+        self.assertNotContains(response, '.uploads')
+
+    def test_hidden_folders_cant_be_opened(self):
+        for path in ('.published', '.published/manifest.json', '.uploads/abc/000000'):
+            self.assertEqual(self.client.get(self.editor_url(path)).status_code, 404)
+            self.assertEqual(self.client.get(self.editor_url(path) + '?action=edit').status_code, 404)
+
+    def test_export_skips_folders(self):
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(export_theme(self.theme))))
+        self.assertEqual(sorted(archive.namelist()), ['templates/page.html', 'theme.json'])
+
+
+class ChunkedUploadTests(AdminTestCase):
+
+    def setUp(self):
+        super(ChunkedUploadTests, self).setUp()
+        self.url = self.editor_url('static') + '?action=upload_ajax'
+
+    def post_chunk(self, upload_id, index, total, data, chunk_size):
+        # The fields DropzoneJS sends with each chunk.
+        return self.client.post(self.url, {
+            'dzuuid': upload_id,
+            'dzchunkindex': index,
+            'dztotalfilesize': len(data),
+            'dzchunksize': chunk_size,
+            'dztotalchunkcount': total,
+            'dzchunkbyteoffset': index * chunk_size,
+            'file_upload': SimpleUploadedFile('big.bin', data[index * chunk_size:(index + 1) * chunk_size]),
+        })
+
+    def test_chunked_upload(self):
+        upload_id = '6f0d9c2e-8a5b-4c1e-9f3a-2b7d4e6a8c10'
+        data = b''.join(bytes([i]) * 10 for i in range(25))
+        chunk_size = 100
+        total = 3
+
+        # Chunks can arrive in any order.
+        for index in (2, 0):
+            response = self.post_chunk(upload_id, index, total, data, chunk_size)
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.url + '&dzuuid=' + upload_id)
+        self.assertEqual(response.json(), {'chunks': [0, 2]})
+
+        done = {
+            'done': 1, 'dzuuid': upload_id, 'dztotalchunkcount': total,
+            'dztotalfilesize': len(data), 'filename': 'big.bin',
+        }
+        response = self.client.post(self.url, done)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Missing chunks: 1', response.json()['error'])
+
+        self.post_chunk(upload_id, 1, total, data, chunk_size)
+        response = self.client.post(self.url, done)
+        self.assertEqual(response.status_code, 200)
+
+        with default_theme_storage.open('test/static/big.bin') as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertFalse(default_theme_storage.exists('.uploads/' + upload_id))
+
+    def test_upload_page_chunks_uploads(self):
+        response = self.client.get(self.url.replace('upload_ajax', 'upload'))
+        self.assertContains(response, 'admin/themes/js/dropzone_chunking.js')
+        self.assertContains(response, 'maxFilesize: 100.000000,')
+        self.assertContains(response, 'chunkSize: 2097152,')
+
+    def test_invalid_upload_id(self):
+        response = self.client.post(self.url, {
+            'dzuuid': '../escape', 'dzchunkindex': 0, 'dztotalchunkcount': 1,
+            'file_upload': SimpleUploadedFile('big.bin', b'data'),
+        })
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,121 @@
+"""
+Chunked, resumable uploads of theme files, and concurrent saving of uploads.
+
+Chunks follow the protocol DropzoneJS uses when ``chunking`` is on: each one
+is posted with a ``dzuuid`` naming the upload and a ``dzchunkindex``. They are
+kept under ``.uploads/<dzuuid>`` in theme storage, so any worker can receive
+any chunk, and are joined into the final file once the client says the upload
+is done.
+"""
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import File
+from django.db import connection
+
+from django_themes.storage import default_theme_storage, replace_file
+
+UPLOAD_DIR = '.uploads'
+UPLOAD_ID_RE = re.compile(r'^[0-9a-fA-F-]{1,64}$')
+UPLOAD_WORKERS = getattr(settings, 'THEMES_UPLOAD_WORKERS', 8)
+# Assembled files smaller than this are kept in memory rather than on disk.
+SPOOL_SIZE = 10 * 1024 * 1024
+# The biggest file that can be uploaded, and the size of the chunks bigger
+# files are uploaded in, in bytes.
+UPLOAD_MAX_SIZE = getattr(settings, 'THEMES_UPLOAD_MAX_SIZE', 100 * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = getattr(settings, 'THEMES_UPLOAD_CHUNK_SIZE', 2 * 1024 * 1024)
+
+
+class UploadError(Exception):
+    pass
+
+
+def upload_path(upload_id, index=None):
+    if not UPLOAD_ID_RE.match(upload_id or ''):
+        raise SuspiciousFileOperation("Invalid upload id: %r" % upload_id)
+    if index is None:
+        return "/".join([UPLOAD_DIR, upload_id])
+    return "/".join([UPLOAD_DIR, upload_id, "%06d" % int(index)])
+
+
+def save_chunk(upload_id, index, content):
+    if content.size > UPLOAD_CHUNK_SIZE:
+        raise UploadError("Chunks can't be bigger than %d bytes." % UPLOAD_CHUNK_SIZE)
+    if int(index) * UPLOAD_CHUNK_SIZE >= UPLOAD_MAX_SIZE:
+        raise UploadError("Files can't be bigger than %d bytes." % UPLOAD_MAX_SIZE)
+    replace_file(default_theme_storage, upload_path(upload_id, index), content)
+
+
+def received_chunks(upload_id):
+    """
+    Returns the sorted indexes of the chunks received so far for an upload,
+    so a client can resume by only sending the rest.
+    """
+    try:
+        folders, files = default_theme_storage.listdir(upload_path(upload_id))
+    except (IOError, OSError):
+        return []
+    return sorted(int(name) for name in files if name.isdigit())
+
+
+def discard_upload(upload_id):
+    for index in received_chunks(upload_id):
+        default_theme_storage.delete(upload_path(upload_id, index))
+    try:
+        # Removes the empty folder from storages that have real folders.
+        default_theme_storage.delete(upload_path(upload_id))
+    except (IOError, OSError):
+        pass
+
+
+def assemble_upload(upload_id, name, total_chunks, total_size=None):
+    """
+    Joins the chunks of an upload and saves them to ``name`` in theme storage,
+    returning the name the file was saved as.
+    """
+    total_chunks = int(total_chunks)
+    if total_chunks < 1:
+        raise UploadError("The number of chunks in the upload is required.")
+    missing = set(range(total_chunks)) - set(received_chunks(upload_id))
+    if missing:
+        raise UploadError("Missing chunks: %s" % ", ".join(map(str, sorted(missing))))
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as assembled:
+        for index in range(total_chunks):
+            with default_theme_storage.open(upload_path(upload_id, index)) as fh:
+                for data in fh.chunks():
+                    assembled.write(data)
+        size = assembled.tell()
+        if size > UPLOAD_MAX_SIZE:
+            raise UploadError("Files can't be bigger than %d bytes." % UPLOAD_MAX_SIZE)
+        if total_size is not None and size != int(total_size):
+            raise UploadError("Expected %s bytes but received %d" % (total_size, size))
+        assembled.seek(0)
+        saved_name = default_theme_storage.save(name, File(assembled, name=name.rsplit('/', 1)[-1]))
+
+    discard_upload(upload_id)
+    return saved_name
+
+
+def save_one(name, content):
+    try:
+        return default_theme_storage.save(name, content)
+    finally:
+        # Each thread gets its own database connection, which would otherwise
+        # be left open by storages that use the database.
+        connection.close()
+
+
+def save_files(files):
+    """
+    Saves each ``(name, content)`` pair in ``files`` to theme storage, using a
+    bounded pool of threads, and returns the names they were saved as.
+    """
+    files = list(files)
+    if len(files) <= 1 or UPLOAD_WORKERS <= 1:
+        return [default_theme_storage.save(name, content) for name, content in files]
+    with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(files))) as executor:
+        return list(executor.map(lambda item: save_one(*item), files))
@@ -1,6 +1,12 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
 from django.core.cache import cache
 
 THEME_CACHE_KEY_PREFIX = "django_themes__"
+# How long, in seconds, a user keeps previewing themes after last choosing them.
+PREVIEW_TIMEOUT = getattr(settings, 'THEMES_PREVIEW_TIMEOUT', 500)
 
 
 def theme_cache_key(user, mode):
@@ -10,27 +16,93 @@ def theme_cache_key(user, mode):
     return "-".join(map(str,[THEME_CACHE_KEY_PREFIX, mode, user_key]))
 
 
-def add_theme_to_preview(user, theme):
-    key = theme_cache_key(user, "previewing")
-    themes_pks = get_previewing_themes(user)
-    themes_pks = list(set(themes_pks + theme.pk))
-    cache.set(key,themes_pks, 500)
-
-
-def get_previewing_themes(user):
-    key = theme_cache_key(user, "previewing")
-    return list(cache.get(key) or [])
+def preview_cache_key(user):
+    return theme_cache_key(user, "previewing")
 
 
-def set_themes_to_preview(user, themes):
-    key = theme_cache_key(user, "previewing")
-    themes_pks = [
+def theme_pks(themes):
+    return [
         # If its a theme object get the PK, if its already a number, return that
         # This will fail spectacularly if a dev gives bad input
         getattr(theme, "pk", None) or int(theme)
         for theme in themes
     ]
-    cache.set(key,themes_pks, 500)
+
+
+def get_previewing_themes(user):
+    return list(cache.get(preview_cache_key(user)) or [])
+
+
+def get_many_previewing_themes(users):
+    """
+    Returns the primary keys of the themes each of ``users`` is previewing,
+    keyed by user primary key, from one cache lookup.
+    """
+    keys = dict((preview_cache_key(user), getattr(user, 'pk', user)) for user in users)
+    found = cache.get_many(list(keys))
+    return dict((user_key, list(found.get(key) or [])) for key, user_key in keys.items())
+
+
+def set_many_themes_to_preview(previews):
+    """
+    Sets the themes previewed by several users with one cache write.
+    ``previews`` maps users, or their primary keys, to themes or theme
+    primary keys.
+    """
+    cache.set_many(
+        dict((preview_cache_key(user), theme_pks(themes)) for user, themes in previews.items()),
+        PREVIEW_TIMEOUT
+    )
+
+
+def set_themes_to_preview(user, themes):
+    set_many_themes_to_preview({user: themes})
+
+
+def add_theme_to_preview(user, theme):
+    themes_pks = get_previewing_themes(user)
+    themes_pks = sorted(set(themes_pks + theme_pks([theme])))
+    set_themes_to_preview(user, themes_pks)
+
+
+def remove_themes_from_preview(user, themes):
+    removed = set(theme_pks(themes))
+    set_themes_to_preview(user, [pk for pk in get_previewing_themes(user) if pk not in removed])
+
+
+def host_patterns(hosts):
+    """
+    Returns the host names and ``*.`` wildcard patterns in ``hosts``, one per
+    line, lower cased.
+    """
+    patterns = []
+    for line in (hosts or '').splitlines():
+        pattern = line.strip().lower().rstrip('.')
+        if pattern:
+            patterns.append(pattern)
+    return patterns
+
+
+def wildcard_patterns(host):
+    """
+    Yields the ``*.`` patterns that match ``host``, most specific first.
+    """
+    labels = host.split('.')
+    for i in range(1, len(labels)):
+        yield '*.' + '.'.join(labels[i:])
+
+
+def theme_path_errors(path):
+    """
+    Returns a list of the reasons ``path`` can't be used for a file in a
+    theme, which is empty if it can.
+    """
+    errors = []
+    if '..' in path:
+        errors.append("No relative paths allowed.")
+    if path.endswith('/') or path.endswith('\\'):
+        errors.append("A filename must follow be included after a directory separator.")
+    return errors
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -39,3 +111,56 @@ def sizeof_fmt(num, suffix='B'):
             return (str(num), unit+suffix)
         num /= 1024.0
     return  (str(num), 'Yi'+suffix)
+
+
+class LRUCache(object):
+    """
+    A small thread-safe mapping that holds at most ``maxsize`` entries,
+    evicting the least recently used entry when it grows past that.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """
+        Removes every entry whose key ``predicate`` returns true for,
+        returning how many were removed.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
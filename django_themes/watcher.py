@@ -0,0 +1,245 @@
+"""
+Watching ``THEMES_FILE_ROOT`` for files changed outside of the admin, such as
+by rsync, when themes are kept in ``FileSystemStorage``.
+
+Changes are gathered until the files have been quiet for a moment, then sent
+on like changes made through the admin: a few files at a time are handled one
+by one, so only the templates that depend on them are invalidated, while a
+theme with many changed files has its manifests rebuilt and all of its
+templates invalidated at once. Either way the generation bump goes through
+Django's cache, so every worker picks it up.
+
+inotify is used where the ``inotify_simple`` package is installed, otherwise
+the tree is polled for changed modified times and sizes.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.db import close_old_connections
+
+from django_themes.manifest import reset_manifests
+from django_themes.publish import PUBLISH_DIR, get_published_manifest, publish_theme
+from django_themes.registry import bump_generation
+from django_themes.signals import theme_file_changed
+from django_themes.storage import default_theme_storage
+from django_themes.uploads import UPLOAD_DIR
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+WATCH_INTERVAL = getattr(settings, 'THEMES_WATCH_INTERVAL', 2)
+# Wait this long after the last change before handling a batch of them.
+WATCH_SETTLE = getattr(settings, 'THEMES_WATCH_SETTLE', 1)
+# A theme with more changed files than this is invalidated as a whole.
+WATCH_BATCH_LIMIT = getattr(settings, 'THEMES_WATCH_BATCH_LIMIT', 20)
+# Folders kept by django-themes itself, whose changes are never sent on.
+IGNORED_FOLDERS = (PUBLISH_DIR, UPLOAD_DIR)
+
+
+def get_watch_root():
+    # Look through a CachedStorage to the storage it wraps.
+    storage = getattr(default_theme_storage, 'storage', default_theme_storage)
+    if not isinstance(storage, FileSystemStorage):
+        raise ImproperlyConfigured(
+            "Only themes kept in FileSystemStorage can be watched, not %s." % storage.__class__.__name__
+        )
+    return os.path.abspath(storage.location)
+
+
+def is_ignored(path):
+    return any(part in IGNORED_FOLDERS for part in path.split('/'))
+
+
+def scan_tree(root):
+    """
+    Returns ``{path: (modified time, size)}`` for every file below ``root``,
+    with paths relative to it.
+    """
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if name not in IGNORED_FOLDERS]
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            path = os.path.relpath(full_path, root).replace(os.sep, '/')
+            files[path] = (stat.st_mtime, stat.st_size)
+    return files
+
+
+class PollingObserver(object):
+    """
+    Finds changed files by scanning the tree every ``interval`` seconds.
+    """
+
+    def __init__(self, root, interval=WATCH_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.files = scan_tree(root)
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        files = scan_tree(self.root)
+        changed = set(
+            path for path in set(files) | set(self.files)
+            if files.get(path) != self.files.get(path)
+        )
+        self.files = files
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyObserver(object):
+    """
+    Finds changed files from inotify events, watching each folder below
+    ``root`` as it appears.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.inotify = inotify_simple.INotify()
+        self.flags = inotify_simple.flags
+        self.mask = (
+            self.flags.CLOSE_WRITE | self.flags.CREATE | self.flags.DELETE |
+            self.flags.MOVED_FROM | self.flags.MOVED_TO | self.flags.DELETE_SELF
+        )
+        self.folders = {}
+        self.add_tree(root)
+
+    def add_tree(self, folder):
+        """
+        Watches ``folder`` and the folders below it, returning the paths of
+        the files already in them.
+        """
+        found = set()
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames[:] = [name for name in dirnames if name not in IGNORED_FOLDERS]
+            try:
+                self.folders[self.inotify.add_watch(dirpath, self.mask)] = dirpath
+            except OSError:
+                continue
+            for name in filenames:
+                found.add(os.path.relpath(os.path.join(dirpath, name), self.root).replace(os.sep, '/'))
+        return found
+
+    def read(self, timeout):
+        changed = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & self.flags.IGNORED:
+                self.folders.pop(event.wd, None)
+                continue
+            folder = self.folders.get(event.wd)
+            if folder is None or not event.name:
+                continue
+            full_path = os.path.join(folder, event.name)
+            if event.mask & self.flags.ISDIR:
+                if event.mask & (self.flags.CREATE | self.flags.MOVED_TO) and event.name not in IGNORED_FOLDERS:
+                    changed.update(self.add_tree(full_path))
+                continue
+            changed.add(os.path.relpath(full_path, self.root).replace(os.sep, '/'))
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+class ThemeWatcher(object):
+    """
+    Watches theme storage and invalidates the caches of themes whose files
+    change. Call ``run`` to watch in the current thread, or ``start`` to
+    watch in a background thread.
+    """
+
+    def __init__(self, root=None, observer=None):
+        self.root = root or get_watch_root()
+        if observer is None:
+            if inotify_simple is not None:
+                observer = InotifyObserver(self.root)
+            else:
+                observer = PollingObserver(self.root)
+        self.observer = observer
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def batches(self):
+        """
+        Yields sets of changed paths, relative to the root, once no more
+        changes have come in for ``WATCH_SETTLE`` seconds.
+        """
+        pending = set()
+        while not self.stopped.is_set():
+            changed = self.observer.read(WATCH_SETTLE if pending else WATCH_INTERVAL)
+            changed = set(path for path in changed if not is_ignored(path))
+            if changed:
+                pending.update(changed)
+            elif pending:
+                yield pending
+                pending = set()
+
+    def themes_for(self, paths):
+        """
+        Returns ``{theme: [path within theme, ...]}`` for the themes holding
+        ``paths``, matching the longest theme path when themes are nested.
+        """
+        from django_themes.models import Theme
+
+        themes = sorted(Theme.objects.all(), key=lambda theme: -len(theme.path.strip('/')))
+        changed = {}
+        for path in paths:
+            for theme in themes:
+                prefix = theme.path.strip('/') + '/'
+                if path.startswith(prefix):
+                    changed.setdefault(theme, []).append(path[len(prefix):])
+                    break
+        return changed
+
+    def dispatch(self, paths):
+        close_old_connections()
+        try:
+            if hasattr(default_theme_storage, 'invalidate'):
+                for path in paths:
+                    default_theme_storage.invalidate(path)
+            for theme, theme_paths in self.themes_for(paths).items():
+                logger.info("%d files changed in theme %s", len(theme_paths), theme)
+                if len(theme_paths) > WATCH_BATCH_LIMIT:
+                    if get_published_manifest(theme) is not None:
+                        publish_theme(theme)
+                    reset_manifests(theme)
+                    bump_generation(invalidated_themes=[theme.pk])
+                else:
+                    for path in sorted(theme_paths):
+                        theme_file_changed.send(sender=self.__class__, theme=theme, path=path)
+        finally:
+            close_old_connections()
+
+    def run(self):
+        try:
+            for paths in self.batches():
+                try:
+                    self.dispatch(paths)
+                except Exception:
+                    logger.exception("Couldn't invalidate themes for %d changed files", len(paths))
+        finally:
+            self.observer.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="django-themes-watcher")
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()